@@ -1,4 +1,7 @@
+import multiprocessing
+
 import project
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     project.main()
@@ -1 +1,6 @@
-from .gui import main
+# The GUI is imported lazily so that worker processes and headless tools can
+# use the rest of the package without loading wx.
+def main():
+    from .gui import main
+
+    main()
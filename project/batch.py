@@ -0,0 +1,274 @@
+import argparse
+import sys
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import rembg
+import rembg.encoders
+import rembg.quantization
+import rembg.scheduler
+
+from .manifest import Manifests
+from .model import (
+    AlphaMatting,
+    AlphaMattingList,
+    BGColor,
+    BGColorList,
+    EncoderType,
+    EncoderTypeList,
+    ModelType,
+    ModelTypeList,
+    Resolution,
+    ResolutionList,
+    Settings,
+)
+from .process_engine import ProcessEngine
+from .process_files import open_mixed
+from .render import inference_resolution, load_image, output_suffix, render_file
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m project.batch",
+        description="Remove the background from image files and folders.",
+    )
+    parser.add_argument("paths", nargs="+", help="image files or folders")
+    parser.add_argument("-m", "--model", choices=ModelTypeList, default="u2net")
+    parser.add_argument(
+        "-b", "--background", choices=BGColorList, default=Settings.bgcolor.name
+    )
+    parser.add_argument(
+        "-f", "--format", choices=EncoderTypeList, default=Settings.encoder.name
+    )
+    parser.add_argument(
+        "-r",
+        "--resolution",
+        choices=ResolutionList,
+        default=Settings.resolution.name,
+        help="inference resolution: preview is faster, high keeps finer detail",
+    )
+    parser.add_argument(
+        "-a",
+        "--alpha-matting",
+        choices=AlphaMattingList,
+        default=Settings.alpha_matting.name,
+        help="refine the mask edges; band only solves around them",
+    )
+    parser.add_argument(
+        "--matting-max-pixels",
+        type=int,
+        default=Settings.matting_max_pixels,
+        help="images larger than this are matted at a reduced scale",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        help="write results here instead of next to the inputs",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        help="files in flight; by default the cores are split between workers "
+        "and ONNX Runtime threads",
+    )
+    parser.add_argument("--backend", choices=("thread", "process"), default="thread")
+    parser.add_argument(
+        "--ort-threads", type=int, help="ONNX Runtime intra-op threads per session"
+    )
+    parser.add_argument(
+        "--affinity",
+        action="store_true",
+        help="pin each worker process to its share of the cores (process backend)",
+    )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="time a few worker counts first and use the fastest (process backend)",
+    )
+    parser.add_argument(
+        "--mask-cache",
+        action="store_true",
+        help="reuse model masks cached on disk for inputs seen before",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="skip files whose output is up to date with the same settings",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="print the time spent encoding",
+    )
+    parser.add_argument(
+        "--iou-report",
+        action="store_true",
+        help="instead of writing outputs, compare the masks of a quantized model "
+        "with those of the fp32 model it was made from",
+    )
+    args = parser.parse_args(argv)
+    # threads share one session, which can be neither pinned nor split
+    if args.backend == "thread" and (args.affinity or args.autotune):
+        parser.error("--affinity and --autotune need --backend process")
+    return args
+
+
+def iou_report(args):
+    source = rembg.session_factory.models[args.model].source
+    if source is None:
+        print(f"{args.model} is not a quantized model", flush=True)
+        return 2
+
+    settings = Settings()
+    settings.model = ModelType[args.model]
+    settings.resolution = Resolution[args.resolution]
+    # both at the same resolution, so only the quantization differs
+    resolution = inference_resolution(settings)
+    session = rembg.get_session(args.model, resolution=resolution)
+    reference = rembg.get_session(source, resolution=resolution)
+    ious = []
+
+    for infile, _ in open_mixed(args.paths):
+        img = load_image(infile)
+        iou = rembg.quantization.iou_report(session, reference, [img])["mean"]
+        ious.append(iou)
+        print(f"[{len(ious)}] {iou:.4f} {infile}", flush=True)
+
+    if ious:
+        print(
+            f"{args.model} vs {source}: mean IoU {sum(ious) / len(ious):.4f}, "
+            f"min {min(ious):.4f} over {len(ious)} images",
+            flush=True,
+        )
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.iou_report:
+        return iou_report(args)
+
+    settings = Settings()
+    settings.model = ModelType[args.model]
+    settings.bgcolor = BGColor[args.background]
+    settings.encoder = EncoderType[args.format]
+    settings.resolution = Resolution[args.resolution]
+    settings.alpha_matting = AlphaMatting[args.alpha_matting]
+    settings.matting_max_pixels = args.matting_max_pixels
+
+    mask_cache = rembg.MaskCache() if args.mask_cache else None
+
+    if args.backend == "process":
+        workers, ort_threads = args.workers, args.ort_threads
+        # decoding, compositing and encoding run here, taking about a core
+        # per worker process, so those are left out of the workers' share
+        reserved = workers or rembg.scheduler.plan_threads(None, ort_threads).workers
+        if args.autotune:
+            tuned = rembg.scheduler.autotune(args.model, reserved=reserved)
+            workers, ort_threads = tuned.workers, tuned.intra_op_num_threads
+            print(f"autotune: {workers} workers x {ort_threads} threads", flush=True)
+
+        engine = ProcessEngine(
+            workers=workers,
+            ort_threads=ort_threads,
+            affinity=args.affinity,
+            reserved=reserved,
+        )
+        workers = engine.workers
+        # decoding and encoding run here, two threads per worker process so
+        # the next image is ready in shared memory when a worker frees up
+        pool = ThreadPoolExecutor(2 * workers)
+
+        def submit(infile, outfile, settings):
+            return pool.submit(
+                engine.render_file, infile, outfile, settings, mask_cache
+            )
+
+        def shutdown():
+            pool.shutdown()
+            engine.shutdown()
+
+    else:
+        plan = rembg.scheduler.plan_threads(args.workers, args.ort_threads, shared=True)
+        workers = plan.workers
+        model_session = rembg.get_session(
+            args.model,
+            intra_op_num_threads=plan.intra_op_num_threads,
+            inter_op_num_threads=plan.inter_op_num_threads,
+            resolution=inference_resolution(settings),
+        )
+        pool = ThreadPoolExecutor(workers)
+
+        def submit(infile, outfile, settings):
+            return pool.submit(
+                render_file, model_session, infile, outfile, settings, mask_cache
+            )
+
+        shutdown = pool.shutdown
+
+    manifests = Manifests()
+    done = 0
+    failed = 0
+    skipped = 0
+    pending = {}
+
+    def skip(infile, outfile):
+        nonlocal skipped
+        current = manifests.is_current(infile, outfile, settings)
+        skipped += current
+        return current
+
+    def report(futures):
+        nonlocal done, failed
+        for future in futures:
+            infile, outfile, job_settings = pending.pop(future)
+            e = future.exception()
+            if e is None:
+                # only incremental runs read the manifests, so only they
+                # pay for writing them
+                if args.incremental:
+                    manifests.record(infile, outfile, job_settings)
+                done += 1
+                print(f"[{done + failed}] ok {infile} -> {outfile}", flush=True)
+            else:
+                failed += 1
+                print(f"[{done + failed}] error {infile}", flush=True)
+                traceback.print_exception(type(e), e, e.__traceback__, file=sys.stdout)
+
+    try:
+        files = open_mixed(
+            args.paths,
+            args.output_dir,
+            output_suffix(settings),
+            skip if args.incremental else None,
+        )
+        for infile, outfile in files:
+            # keep a bounded number of files in flight
+            if len(pending) >= 2 * workers:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                report(finished)
+            pending[submit(infile, outfile, settings)] = (infile, outfile, settings)
+
+        report(wait(pending).done)
+    finally:
+        shutdown()
+        manifests.flush()
+
+    summary = f"{done} done, {failed} failed"
+    if args.incremental:
+        summary += f", {skipped} up to date"
+    print(summary, flush=True)
+
+    if args.timings:
+        for name, (count, seconds) in rembg.encoders.encoder_timings().items():
+            print(
+                f"{name}: {count} images, {seconds:.3f}s, "
+                f"{1000 * seconds / count:.1f}ms per image",
+                flush=True,
+            )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,6 +10,7 @@ from pubsub import pub
 from . import operations, process_files
 from .model import *
 from .operations import msg
+from .render import output_suffix
 
 try:
     from os import startfile
@@ -19,6 +20,27 @@ except ImportError:
         pass
 
 
+# the list and status bar are redrawn at most this often, in milliseconds
+REFRESH_INTERVAL = 100
+
+
+def sort_key(file, status):
+    return (status.value, file.dir, file.name)
+
+
+def find_row(files, key):
+    # bisect_left over rows sorted by the status each was last placed under
+    lo, hi = 0, len(files)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        file = files[mid]
+        if sort_key(file, file.sorted_status) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
 class CustomDropTarget(wx.FileDropTarget):
     def __init__(self, callbacks):
         super().__init__()
@@ -54,13 +76,21 @@ class MainFrame(wx.Frame):
         super().__init__(*args, **kw)
 
         self.count = 0
+        # Rows stay sorted by sort_key. Each job remembers the status it was
+        # placed under, so its row can be found again by bisection after a
+        # worker has changed its status.
+        self.jobs = JobTable()
         self.files = []
-        self.files_seen = set()
+        self._added = []
+        self._changed = {}
         self.task_queue = []
         self.discover_threads = 0
+        # traceback of each failed job, shown when its row is activated
+        self.errors = {}
         self.settings = Settings()
+        self.backend = "thread"
 
-        self.session = operations.new_session()
+        self.session = operations.new_session(backend=self.backend)
         self.DropTarget = CustomDropTarget(self)
         self.makeMenuBar()
         self.CreateStatusBar()
@@ -72,18 +102,21 @@ class MainFrame(wx.Frame):
         self.DropCallbackLeave()
         self.SetSizerAndFit(self.sizer)
 
-        self.update_files()
         self.done_iterator()
 
-        pub.subscribe(self.discoverFile, "discoverFile")
+        pub.subscribe(self.discoverFiles, "discoverFiles")
         pub.subscribe(self.done_iterator, "discoverDone")
         pub.subscribe(self.fatalError, "fatalError")
-        pub.subscribe(self.update_files, "update_files")
-        pub.subscribe(self.model_sessions_loaded, "model_sessions_loaded")
+        pub.subscribe(self.jobError, "jobError")
+        pub.subscribe(self.update_file, "update_file")
 
-        self.Bind(wx.EVT_CHAR_HOOK, self.OnKeyUP)
+        # Messages only record what changed; the timer applies it in one go,
+        # so a burst of thousands of updates costs one redraw.
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnRefresh, self.timer)
+        self.timer.Start(REFRESH_INTERVAL)
 
-        wx.CallAfter(operations.load_model_sessions)
+        self.Bind(wx.EVT_CHAR_HOOK, self.OnKeyUP)
 
     def makePanel(self):
         self.pnl = wx.Panel(self)
@@ -110,10 +143,22 @@ class MainFrame(wx.Frame):
         self.Bind(wx.EVT_BUTTON, self.OnBtnSetModel, btn)
         sizer2.Add(btn, sizer_flags)
 
+        btn = wx.Button(self.pnl, label="Set Resolution")
+        self.Bind(wx.EVT_BUTTON, self.OnBtnSetResolution, btn)
+        sizer2.Add(btn, sizer_flags)
+
+        btn = wx.Button(self.pnl, label="Set Matting")
+        self.Bind(wx.EVT_BUTTON, self.OnBtnSetMatting, btn)
+        sizer2.Add(btn, sizer_flags)
+
         btn = wx.Button(self.pnl, label="Set Background")
         self.Bind(wx.EVT_BUTTON, self.OnBtnSetBackground, btn)
         sizer2.Add(btn, sizer_flags)
 
+        btn = wx.Button(self.pnl, label="Set Format")
+        self.Bind(wx.EVT_BUTTON, self.OnBtnSetFormat, btn)
+        sizer2.Add(btn, sizer_flags)
+
         btn = wx.Button(self.pnl, label="Clear Completed")
         self.Bind(wx.EVT_BUTTON, self.OnBtnClear, btn)
         sizer2.Add(btn, sizer_flags)
@@ -136,11 +181,15 @@ class MainFrame(wx.Frame):
         self.sizer.Add(self.pnl, 1, wx.EXPAND)
 
     def getItemText(self, item, column):
-        if item > len(self.files):
+        if item >= len(self.files):
             return ""
 
         item = self.files[item]
-        return str((item.file, item.outfile, item.status.name)[column])
+        if column == 0:
+            return str(item.file)
+        if column == 1:
+            return str(item.outfile)
+        return item.status.name
 
     def itemClicked(self, event):
         try:
@@ -150,6 +199,12 @@ class MainFrame(wx.Frame):
 
         if file.status == Status.Done:
             startfile(file.outfile.parent)
+        elif file.status == Status.Error and file in self.errors:
+            wx.MessageBox(
+                f"{file.file}\n\n" + "".join(self.errors[file]),
+                "Error",
+                wx.OK | wx.ICON_ERROR,
+            )
 
     def fatalError(self, e, ctx):
         wx.MessageBox(
@@ -159,22 +214,87 @@ class MainFrame(wx.Frame):
         )
         self.OnExit()
 
+    def jobError(self, file, e):
+        self.errors[file] = e
+
+    def update_file(self, file):
+        self._changed[id(file)] = file
+
+    def OnRefresh(self, event):
+        self.update_files()
+        self.update_status()
+        self.session.model_sessions.evict_idle()
+
     def update_files(self):
-        self.files.sort(key=lambda x: (x.status.value, x.file))
+        if not self._added and not self._changed:
+            return
+
+        count = len(self.files)
+        first = last = None
+
+        for file in self._changed.values():
+            # a late update for a job that has since been cleared
+            if file.table is None:
+                continue
+            if file.sorted_status is None or file.sorted_status == file.status:
+                continue
+
+            i = find_row(self.files, sort_key(file, file.sorted_status))
+            if i == len(self.files) or self.files[i] is not file:
+                # not where it was sorted; better to search than to remove
+                # another job's row
+                try:
+                    i = self.files.index(file)
+                except ValueError:
+                    file.sorted_status = None
+                    continue
+            del self.files[i]
+
+            j = self._insert(file)
+            first = min(i, j) if first is None else min(first, i, j)
+            last = max(i, j) if last is None else max(last, i, j)
+        self._changed.clear()
+
+        for file in self._added:
+            j = self._insert(file)
+            first = j if first is None else min(first, j)
+            last = len(self.files) - 1
+        self._added.clear()
+
+        if len(self.files) != count:
+            self.queue.SetItemCount(len(self.files))
+        if first is not None:
+            self.queue.RefreshItems(first, last)
+
+    def _insert(self, file):
+        status = file.status
+        i = find_row(self.files, sort_key(file, status))
+        self.files.insert(i, file)
+        file.sorted_status = status
+        return i
+
+    def reset_files(self, files):
+        for file in files:
+            file.sorted_status = file.status
+        self.files = sorted(files, key=lambda file: sort_key(file, file.sorted_status))
+
         self.queue.SetItemCount(len(self.files))
         if self.files:
             self.queue.RefreshItems(0, len(self.files) - 1)
-        self.update_status()
 
     def update_status(self):
         if self.discover_threads > 0:
             text = "Discovering files..."
-        elif not self.session.model_sessions:
+        elif self.session.model_sessions.loading:
             text = "Loading models..."
-        elif any(file.status not in {Status.Done, Status.Error} for file in self.files):
+        elif self.jobs.unfinished():
             text = "Processing files..."
+            if self.session.pipeline is not None:
+                depths = self.session.pipeline.queue_depths()
+                text += "  " + "  ".join(f"{k}: {v}" for k, v in depths.items())
         else:
             text = "Idle"
+            self.session.manifests.flush()
 
         self.SetStatusText(text)
 
@@ -208,6 +328,22 @@ class MainFrame(wx.Frame):
 
         fileMenu.AppendSeparator()
 
+        incrementalItem = fileMenu.AppendCheckItem(-1, "Skip &up-to-date outputs")
+        incrementalItem.Check(self.settings.incremental)
+        self.Bind(wx.EVT_MENU, self.OnIncremental, incrementalItem)
+
+        maskCacheItem = fileMenu.AppendCheckItem(-1, "&Cache model masks on disk")
+        maskCacheItem.Check(self.session.mask_cache is not None)
+        self.Bind(wx.EVT_MENU, self.OnMaskCache, maskCacheItem)
+
+        self.processesItem = fileMenu.AppendCheckItem(
+            -1, "Run models in worker &processes"
+        )
+        self.processesItem.Check(self.backend == "process")
+        self.Bind(wx.EVT_MENU, self.OnProcesses, self.processesItem)
+
+        fileMenu.AppendSeparator()
+
         exitItem = fileMenu.Append(wx.ID_EXIT)
         self.Bind(wx.EVT_MENU, self.OnExit, exitItem)
 
@@ -217,8 +353,36 @@ class MainFrame(wx.Frame):
         self.MenuBar = menuBar
 
     def OnExit(self, *args):
+        self.timer.Stop()
+        self.session.manifests.flush()
         self.Close(True)
 
+    def OnIncremental(self, event):
+        self.settings.incremental = event.IsChecked()
+
+    def OnMaskCache(self, event):
+        operations.set_mask_cache(self.session, event.IsChecked())
+
+    def OnProcesses(self, event):
+        # the backend is fixed for the life of a session, so switching starts
+        # a new one, which can only be done while nothing is queued
+        if self.jobs.unfinished() or self.discover_threads > 0:
+            self.processesItem.Check(self.backend == "process")
+            wx.MessageBox(
+                "Wait for the queue to finish before switching.",
+                "Busy",
+                wx.OK | wx.ICON_INFORMATION,
+            )
+            return
+
+        mask_cache = self.session.mask_cache is not None
+        operations.close_session(self.session)
+        self.backend = "process" if event.IsChecked() else "thread"
+        self.session = operations.new_session(
+            backend=self.backend, mask_cache=mask_cache
+        )
+        self.update_status()
+
     def OnBtnFiles(self, event):
         with wx.FileDialog(
             self,
@@ -228,7 +392,13 @@ class MainFrame(wx.Frame):
         ) as dialog:
             if dialog.ShowModal() == wx.ID_CANCEL:
                 return
-            self.process_iterator(process_files.open_files(dialog.Paths))
+            settings = copy(self.settings)
+            self.process_iterator(
+                process_files.open_files(
+                    dialog.Paths, **self.discover_options(settings)
+                ),
+                settings,
+            )
 
     def OnBtnDirs(self, event):
         with wx.DirDialog(
@@ -237,7 +407,13 @@ class MainFrame(wx.Frame):
         ) as dialog:
             if dialog.ShowModal() == wx.ID_CANCEL:
                 return
-            self.process_iterator(process_files.open_folder(dialog.Path))
+            settings = copy(self.settings)
+            self.process_iterator(
+                process_files.open_folder(
+                    dialog.Path, **self.discover_options(settings)
+                ),
+                settings,
+            )
 
     def OnBtnSetModel(self, event):
         with wx.SingleChoiceDialog(self, "", "Select model", ModelTypeList) as dialog:
@@ -246,6 +422,41 @@ class MainFrame(wx.Frame):
                 return
             self.settings.model = ModelType[ModelTypeList[dialog.GetSelection()]]
 
+    def OnBtnSetResolution(self, event):
+        with wx.SingleChoiceDialog(
+            self, "", "Select inference resolution", ResolutionList
+        ) as dialog:
+            dialog.SetSelection(ResolutionList.index(self.settings.resolution.name))
+            if dialog.ShowModal() == wx.ID_CANCEL:
+                return
+            self.settings.resolution = Resolution[ResolutionList[dialog.GetSelection()]]
+
+    def OnBtnSetMatting(self, event):
+        with wx.SingleChoiceDialog(
+            self, "", "Select alpha matting", AlphaMattingList
+        ) as dialog:
+            dialog.SetSelection(
+                AlphaMattingList.index(self.settings.alpha_matting.name)
+            )
+            if dialog.ShowModal() == wx.ID_CANCEL:
+                return
+            matting = AlphaMatting[AlphaMattingList[dialog.GetSelection()]]
+
+        if matting != AlphaMatting.off:
+            megapixels = wx.GetNumberFromUser(
+                "Larger images are matted at a reduced scale.",
+                "Megapixels",
+                "Matting pixel budget",
+                max(1, self.settings.matting_max_pixels // 10**6),
+                1,
+                1000,
+                self,
+            )
+            if megapixels < 0:
+                return
+            self.settings.matting_max_pixels = megapixels * 10**6
+        self.settings.alpha_matting = matting
+
     def OnBtnSetBackground(self, event):
         with wx.SingleChoiceDialog(
             self, "", "Select background", BGColorList
@@ -255,57 +466,71 @@ class MainFrame(wx.Frame):
                 return
             self.settings.bgcolor = BGColor[BGColorList[dialog.GetSelection()]]
 
+    def OnBtnSetFormat(self, event):
+        with wx.SingleChoiceDialog(
+            self, "", "Select output format", EncoderTypeList
+        ) as dialog:
+            dialog.SetSelection(EncoderTypeList.index(self.settings.encoder.name))
+            if dialog.ShowModal() == wx.ID_CANCEL:
+                return
+            self.settings.encoder = EncoderType[EncoderTypeList[dialog.GetSelection()]]
+
     def OnBtnClear(self, event):
         to_keep = []
         for file in self.files:
             if file.status == Status.Done:
-                self.files_seen.discard(file.file)
+                self.jobs.remove(file)
+                file.sorted_status = None
             else:
                 to_keep.append(file)
 
-        self.files = to_keep
-        self.update_files()
+        # statuses may have changed since the last refresh
+        self._changed.clear()
+        self.reset_files(to_keep + self._added)
+        self._added.clear()
+        self.update_status()
 
     def DropCallbackFiles(self, files):
         self.DropCallbackLeave()
-        self.process_iterator(process_files.open_mixed(files))
+        settings = copy(self.settings)
+        self.process_iterator(
+            process_files.open_mixed(files, **self.discover_options(settings)),
+            settings,
+        )
+
+    # Jobs are named and run with the settings copied when they were
+    # discovered, so changing them later can't give a .png file WebP bytes.
+    def discover_options(self, settings):
+        skip = None
+        if settings.incremental:
+            skip = partial(self.session.manifests.is_current, settings=settings)
+        return {"suffix": output_suffix(settings), "skip": skip}
 
-    def process_iterator(self, iterator):
+    def process_iterator(self, iterator, settings):
         self.discover_threads += 1
         self.update_status()
 
-        wx.CallAfter(operations.queue_discover, self.session, iterator)
+        wx.CallAfter(operations.queue_discover, self.session, iterator, settings)
 
     def done_iterator(self):
         self.discover_threads -= 1
 
         self.update_status()
 
-    def model_sessions_loaded(self, model_sessions):
-        assert model_sessions
-        self.session.model_sessions = model_sessions
-        self.update_status()
-        wx.CallAfter(self.check_task_queue)
-
-    def discoverFile(self, file, outfile):
-        if file in self.files_seen:
-            return
+    def discoverFiles(self, files, settings):
+        for file, outfile in files:
+            file = self.jobs.add(file, outfile, settings)
+            if file is None:
+                continue
 
-        self.files_seen.add(file)
+            self._added.append(file)
+            self.task_queue.append(file)
 
-        file = File(file=file, outfile=outfile, status=Status.Pending)
-        self.files.append(file)
-        self.update_files()
-
-        self.task_queue.append(file)
         wx.CallAfter(self.check_task_queue)
 
     def check_task_queue(self):
-        if self.session.model_sessions is None:
-            return
-
         for file in self.task_queue:
-            operations.queue_file(self.session, file, self.settings)
+            operations.queue_file(self.session, file)
         self.task_queue.clear()
 
     def DropCallbackEnter(self):
@@ -0,0 +1,117 @@
+import json
+import os
+import time
+from pathlib import Path
+from threading import Lock
+
+MANIFEST_NAME = ".rembg-manifest.json"
+MANIFEST_VERSION = 1
+SAVE_INTERVAL = 5
+
+
+def _stamp(path):
+    st = path.stat()
+    return [st.st_size, st.st_mtime_ns]
+
+
+def settings_key(settings):
+    # everything that changes the pixels or the format of an output; the
+    # default resolution and matting are left out so older manifests still
+    # match
+    key = {
+        "model": settings.model.name,
+        "bgcolor": settings.bgcolor.name,
+        "encoder": settings.encoder.name,
+    }
+    if settings.resolution.name != "default":
+        key["resolution"] = settings.resolution.name
+    if settings.alpha_matting.name != "off":
+        key["alpha_matting"] = settings.alpha_matting.name
+        key["matting_max_pixels"] = settings.matting_max_pixels
+    return key
+
+
+class Manifests:
+    # One JSON manifest per output directory, mapping each output file name to
+    # the input it was made from, the size and mtime of both files and the
+    # settings used. An output is up to date when all of them still match.
+    def __init__(self, save_interval=SAVE_INTERVAL):
+        self.save_interval = save_interval
+
+        self._lock = Lock()
+        self._write_lock = Lock()
+        self._manifests = {}
+        self._dirty = set()
+        self._last_save = time.monotonic()
+
+    def is_current(self, infile, outfile, settings):
+        infile, outfile = Path(infile), Path(outfile)
+        with self._lock:
+            entry = self._entries(outfile.parent).get(outfile.name)
+
+        if entry is None:
+            return False
+
+        try:
+            return entry == {
+                "input": str(infile),
+                "input_stamp": _stamp(infile),
+                "output_stamp": _stamp(outfile),
+                "settings": settings_key(settings),
+            }
+        except OSError:
+            return False
+
+    # settings must be the ones the output was made with, not whatever they
+    # are by the time it is done
+    def record(self, infile, outfile, settings):
+        infile, outfile = Path(infile), Path(outfile)
+        entry = {
+            "input": str(infile),
+            "input_stamp": _stamp(infile),
+            "output_stamp": _stamp(outfile),
+            "settings": settings_key(settings),
+        }
+
+        with self._lock:
+            self._entries(outfile.parent)[outfile.name] = entry
+            self._dirty.add(outfile.parent)
+            due = time.monotonic() - self._last_save >= self.save_interval
+
+        # writes are batched so a large folder doesn't rewrite its manifest
+        # once per file; flush() writes whatever is left
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                dirty = {
+                    folder: dict(self._manifests[folder]) for folder in self._dirty
+                }
+                self._dirty.clear()
+                self._last_save = time.monotonic()
+
+            for folder, entries in dirty.items():
+                path = folder / MANIFEST_NAME
+                tmp = path.with_name(path.name + ".tmp")
+                try:
+                    tmp.write_text(
+                        json.dumps({"version": MANIFEST_VERSION, "entries": entries})
+                    )
+                    os.replace(tmp, path)
+                except OSError:
+                    pass
+
+    def _entries(self, folder):
+        entries = self._manifests.get(folder)
+        if entries is None:
+            entries = {}
+            try:
+                data = json.loads((folder / MANIFEST_NAME).read_text())
+                if data["version"] == MANIFEST_VERSION:
+                    entries = data["entries"]
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+            self._manifests[folder] = entries
+        return entries
@@ -1,21 +1,158 @@
+import os
+import sys
 from dataclasses import dataclass
 from enum import Enum
+from pathlib import Path
+from threading import Lock
+
+import rembg.session_factory
 
 Status = Enum("Status", "Error Running Pending Done")
 
 
-@dataclass
 class File:
-    file: str
-    outfile: str
-    status: Status
+    # One job. Paths are kept as an interned directory, shared by every job
+    # in that folder, plus a file name; the output usually has the input's
+    # name with another suffix, and then only the interned suffix is kept.
+    # settings is the copy taken when the job was discovered, which its
+    # output name was made with, shared by the jobs discovered together.
+    # Status changes are counted by the JobTable the job belongs to, if any.
+    __slots__ = (
+        "dir",
+        "name",
+        "outdir",
+        "outname",
+        "outsuffix",
+        "settings",
+        "_status",
+        "table",
+        "sorted_status",
+    )
+
+    def __init__(self, file, outfile, settings=None, status=Status.Pending, table=None):
+        self.dir, self.name = _split(file)
+        self.outdir = self.outname = self.outsuffix = None
+        if outfile is not None:
+            self.outdir, self.outname = _split(outfile)
+            stem, suffix = os.path.splitext(self.outname)
+            if stem == os.path.splitext(self.name)[0]:
+                self.outname = None
+                self.outsuffix = sys.intern(suffix)
+        self.settings = settings
+        self._status = status
+        self.table = table
+        # the status the GUI last sorted this job under
+        self.sorted_status = None
+
+    @property
+    def file(self):
+        return Path(self.dir, self.name)
+
+    @property
+    def outfile(self):
+        if self.outdir is None:
+            return None
+        if self.outname is None:
+            return Path(self.outdir, os.path.splitext(self.name)[0] + self.outsuffix)
+        return Path(self.outdir, self.outname)
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        table = self.table
+        if table is None:
+            self._status = status
+        else:
+            table._set_status(self, status)
+
+    def __repr__(self):
+        return (
+            f"File(file={self.file!r}, outfile={self.outfile!r}, status={self.status})"
+        )
+
+
+def _split(path):
+    folder, name = os.path.split(os.fspath(path))
+    return sys.intern(folder), name
+
+
+class JobTable:
+    # Every job by directory and name, for O(1) lookup by path, plus a
+    # counter per status kept up to date on every transition.
+    def __init__(self):
+        self._lock = Lock()
+        self._dirs = {}
+        self._counts = dict.fromkeys(Status, 0)
+        self._size = 0
+
+    def add(self, file, outfile, settings=None, status=Status.Pending):
+        # None if the file is already in the table
+        job = File(file, outfile, settings, status, self)
+        with self._lock:
+            names = self._dirs.setdefault(job.dir, {})
+            if job.name in names:
+                return None
+            names[job.name] = job
+            self._counts[status] += 1
+            self._size += 1
+        return job
+
+    def get(self, file):
+        folder, name = os.path.split(os.fspath(file))
+        with self._lock:
+            return self._dirs.get(folder, {}).get(name)
+
+    def remove(self, job):
+        with self._lock:
+            names = self._dirs.get(job.dir)
+            if names is None or names.get(job.name) is not job:
+                return
+            del names[job.name]
+            if not names:
+                del self._dirs[job.dir]
+            self._counts[job.status] -= 1
+            self._size -= 1
+            job.table = None
+
+    def count(self, status):
+        return self._counts[status]
+
+    def unfinished(self):
+        with self._lock:
+            return self._size - self._counts[Status.Done] - self._counts[Status.Error]
+
+    def __contains__(self, file):
+        return self.get(file) is not None
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        with self._lock:
+            jobs = [job for names in self._dirs.values() for job in names.values()]
+        return iter(jobs)
+
+    def _set_status(self, job, status):
+        with self._lock:
+            if job.table is not self:
+                job._status = status
+                return
+            self._counts[job._status] -= 1
+            self._counts[status] += 1
+            job._status = status
 
 
 @dataclass
 class Session:
     model_sessions: None
-    pool: None
+    pipeline: None
     discover_pool: None
+    engine: None = None
+    manifests: None = None
+    mask_cache: None = None
 
 
 class BGColor(Enum):
@@ -27,12 +164,50 @@ class BGColor(Enum):
 
 BGColorList = [bgcolor.name for bgcolor in BGColor]
 
-ModelType = Enum("ModelType", "u2net u2netp u2net_human_seg u2net_cloth_seg")
+# the int8 models are left out when rembg can't quantize them
+ModelType = Enum(
+    "ModelType",
+    [
+        name
+        for name in (
+            "u2net u2netp u2net_human_seg u2net_cloth_seg u2net_int8 u2netp_int8"
+        ).split()
+        if name in rembg.session_factory.models
+    ],
+)
 
 ModelTypeList = [model.name for model in ModelType]
 
+# names of the encoders in rembg.encoders
+EncoderType = Enum("EncoderType", "png png_fast png_optimize webp_lossless npy jpeg")
+
+EncoderTypeList = [encoder.name for encoder in EncoderType]
+
+
+# inference resolution as a fraction of the model's own, 320 for most models
+class Resolution(Enum):
+    preview = 0.6
+    default = 1.0
+    high = 1.6
+
+
+ResolutionList = [resolution.name for resolution in Resolution]
+
+# off, or the rembg alpha_matting_mode to matte the mask edges with
+AlphaMatting = Enum("AlphaMatting", "off full band")
+
+AlphaMattingList = [matting.name for matting in AlphaMatting]
+
+# images larger than this are matted at a reduced scale
+DEFAULT_MATTING_MAX_PIXELS = 10**6
+
 
 @dataclass
 class Settings:
     bgcolor = BGColor.Green
     model = ModelType.u2net
+    encoder = EncoderType.png
+    resolution = Resolution.default
+    alpha_matting = AlphaMatting.off
+    matting_max_pixels = DEFAULT_MATTING_MAX_PIXELS
+    incremental = False
@@ -1,113 +1,260 @@
-import sys
+import io
 import traceback
 from concurrent.futures import ThreadPoolExecutor
-from threading import Thread
+from dataclasses import dataclass
+from functools import partial
 
 import wx
-from PIL import Image
 from pubsub import pub
 
 import rembg
+import rembg.scheduler
 import rembg.session_factory
 
-from .model import File, ModelType, Session, Settings, Status
+from .manifest import Manifests
+from .model import File, Session, Settings, Status
+from .pipeline import Pipeline, Stage
+from .process_engine import ProcessEngine
+from .process_files import batched
+from .render import compose, inference_resolution, load_image, save_image
+from .sessions import DEFAULT_MEMORY_BUDGET, ModelSessions
 
 
 def msg(*args, **kwargs):
     wx.CallAfter(pub.sendMessage, *args, **kwargs)
 
 
-class CustomThread(Thread):
-    def __init__(self, func):
-        super().__init__(daemon=True)
-        self.func = func
-        self.start()
-
-    def run(self, *args):
-        try:
-            self.func()
-        except Exception:
-            msg(
-                "fatalError",
-                e=traceback.format_exception(*sys.exc_info()),
-                ctx=self.func.__name__,
-            )
-            raise
+STAGE_WORKERS = {
+    "decode": 2,
+    "preprocess": 2,
+    "infer": 2,
+    "postprocess": 2,
+    "encode": 2,
+}
+
 
+def new_session(
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+    backend="thread",
+    workers=None,
+    ort_threads=None,
+    stage_workers=None,
+    mask_cache=False,
+    affinity=False,
+    autotune=None,
+):
+    # workers is the number of worker processes, or on the thread backend
+    # the number of infer threads unless stage_workers sets those. autotune
+    # names a model to time thread splits with before starting the process
+    # backend; it picks the workers and ORT threads
+    cache = rembg.MaskCache() if mask_cache else None
 
-def new_session():
-    model_sessions = None
-    pool = ThreadPoolExecutor(8)
+    engine = None
+    stage_workers = dict(stage_workers or {})
+    # the other stages decode, composite and encode alongside inference, so
+    # ORT is planned around their threads rather than all the cores
+    reserved = sum(
+        count
+        for name, count in {**STAGE_WORKERS, **stage_workers}.items()
+        if name != "infer"
+    )
+    if backend == "process":
+        if autotune is not None:
+            tuned = rembg.scheduler.autotune(autotune, reserved=reserved)
+            workers = tuned.workers
+            ort_threads = tuned.intra_op_num_threads
+        engine = ProcessEngine(
+            workers=workers,
+            ort_threads=ort_threads,
+            affinity=affinity,
+            reserved=reserved,
+        )
+        plan = engine.plan
+        # each infer thread waits on one worker process; twice as many keep
+        # the next image ready in shared memory while a worker is busy
+        stage_workers["infer"] = 2 * engine.workers
+    elif backend == "thread":
+        if workers is not None:
+            stage_workers.setdefault("infer", workers)
+        # the infer workers share one session per model, and so one intra-op
+        # pool, which gets the cores the other stages leave
+        plan = rembg.scheduler.plan_threads(
+            stage_workers.get("infer", STAGE_WORKERS["infer"]),
+            ort_threads,
+            shared=True,
+            reserved=reserved,
+        )
+    else:
+        raise ValueError(f"Unknown backend {backend!r}")
+    pipeline = new_pipeline({**STAGE_WORKERS, **stage_workers})
+
+    loader = partial(
+        rembg.new_session,
+        intra_op_num_threads=plan.intra_op_num_threads,
+        inter_op_num_threads=plan.inter_op_num_threads,
+    )
+    model_sessions = ModelSessions(memory_budget=memory_budget, loader=loader)
     discover_pool = ThreadPoolExecutor(1)
     session = Session(
-        model_sessions=model_sessions, pool=pool, discover_pool=discover_pool
+        model_sessions=model_sessions,
+        pipeline=pipeline,
+        discover_pool=discover_pool,
+        engine=engine,
+        manifests=Manifests(),
+        mask_cache=cache,
     )
     return session
 
 
-def load_model_sessions():
-    CustomThread(_load_model_sessions)
-
+# only once nothing is queued, see Pipeline.shutdown
+def close_session(session: Session):
+    session.pipeline.shutdown()
+    session.discover_pool.shutdown(wait=False)
+    if session.engine is not None:
+        session.engine.shutdown(wait=False)
+    session.manifests.flush()
 
-def _load_model_sessions():
-    model_sessions = {}
 
-    with ThreadPoolExecutor(1) as pool:
-        for model in ModelType:
-            pool.submit(__load_model_sessions, model_sessions, model.name)
-    __import__("time").sleep(10)
-    assert len(model_sessions) == len(ModelType)
-    msg("model_sessions_loaded", model_sessions=model_sessions)
+# Jobs already running keep the cache they started with. With the cache on,
+# re-running with only another background costs a composite.
+def set_mask_cache(session: Session, enabled):
+    session.mask_cache = rembg.MaskCache() if enabled else None
 
 
-def __load_model_sessions(model_sessions, model):
-    try:
-        model_sessions[model] = rembg.session_factory.new_session(model)
-    except Exception:
-        msg(
-            "fatalError",
-            ctx=f"model {model}",
-            e=traceback.format_exception(*sys.exc_info()),
-        )
-        raise
+def new_pipeline(stage_workers):
+    stages = [
+        Stage("decode", _decode),
+        Stage("preprocess", _preprocess),
+        Stage("infer", _infer),
+        Stage("postprocess", _postprocess),
+        Stage("encode", _encode),
+    ]
+    for stage in stages:
+        stage.workers = stage_workers[stage.name]
+    return Pipeline(stages)
 
 
-def queue_discover(session: Session, iterator):
-    session.discover_pool.submit(_queue_discover, iterator)
+def queue_discover(session: Session, iterator, settings: Settings):
+    session.discover_pool.submit(_queue_discover, iterator, settings)
 
 
-def _queue_discover(iterator):
-    for file, outfile in iterator:
-        msg("discoverFile", file=file, outfile=outfile)
+def _queue_discover(iterator, settings):
+    for files in batched(iterator):
+        msg("discoverFiles", files=files, settings=settings)
     msg("discoverDone")
 
 
-# nonblocking
-def queue_file(session: Session, file: File, settings: Settings):
-    future = session.pool.submit(do_work, session, file, settings)
-    future.add_done_callback(done_callback)
-
-
-def do_work(session: Session, file: File, settings: Settings):
-    file.status = Status.Running
-    msg("update_files")
-
-    try:
-        session = session.model_sessions[settings.model.name]
-        with Image.open(file.file) as image:
-            out_image = rembg.remove(image, session=session)
-        new_image = Image.new("RGBA", out_image.size, settings.bgcolor.value)
-        new_image = Image.alpha_composite(new_image, out_image)
-        file.outfile.parent.mkdir(parents=True, exist_ok=True)
-        new_image.save(file.outfile)
-    except Exception:
-        file.status = Status.Error
-        msg("fatalError", ctx=file, e=traceback.format_exception(*sys.exc_info()))
-        raise
+@dataclass
+class Work:
+    session: Session
+    file: File
+    settings: Settings
+    model_session: None = None
+    image: None = None
+    data: None = None
+    # the session's mask cache when the job started, as it can be switched
+    # off while jobs are running
+    mask_cache: None = None
+    key: None = None
+    masks: None = None
+
+
+# nonblocking; runs with the settings the file was discovered with
+def queue_file(session: Session, file: File):
+    session.pipeline.submit(Work(session, file, file.settings), work_done_callback)
+
+
+def _decode(work: Work):
+    work.file.status = Status.Running
+    msg("update_file", file=work.file)
+
+    cache = work.mask_cache = work.session.mask_cache
+    if cache is None:
+        work.image = load_image(work.file.file)
+        return work
+
+    data, work.key, work.masks = cache.lookup_file(
+        work.file.file, work.settings.model.name, inference_resolution(work.settings)
+    )
+    work.image = load_image(io.BytesIO(data))
+    return work
+
+
+# On a mask cache hit the model is neither loaded nor run; only compositing
+# and encoding happen, so re-rendering with another background is cheap.
+def _preprocess(work: Work):
+    if work.masks is not None:
+        return work
+
+    if work.session.engine is not None:
+        # the worker process preprocesses; it is sent the decoded pixels
+        return work
+
+    work.model_session = work.session.model_sessions.get(
+        work.settings.model.name, inference_resolution(work.settings)
+    )
+    # the tensor is handed to another thread, so it can't use the
+    # per-thread input buffer
+    work.data = work.model_session.preprocess([work.image], reuse_buffer=False)
+    return work
+
+
+def _infer(work: Work):
+    if work.masks is not None:
+        return work
+
+    engine = work.session.engine
+    if engine is None:
+        work.data = work.model_session.run(work.data)
     else:
-        file.status = Status.Done
-        msg("update_files")
+        # blocks this thread, not the GIL, until the worker is done
+        work.data = engine.submit_predict(
+            work.image, work.settings.model.name, inference_resolution(work.settings)
+        ).result()
+    return work
+
 
+def _postprocess(work: Work):
+    if work.masks is None:
+        if work.model_session is None:
+            # already decoded by the worker process
+            work.masks = work.data
+        else:
+            work.masks = work.model_session.decode_masks(work.data)[0]
+        if work.key is not None:
+            work.mask_cache.put(work.key, work.masks)
 
-def done_callback(future):
-    future.result()  # raise exception
+    session_class = rembg.session_factory.models[work.settings.model.name].session_class
+    masks = session_class.upscale_masks(work.image, work.masks)
+    work.data = compose(work.image, masks, work.settings)
+    work.masks = None
+    work.image = None
+    return work
+
+
+def _encode(work: Work):
+    save_image(work.data, work.file.outfile, work.settings.encoder.name)
+    work.data = None
+    return work
+
+
+def work_done_callback(work: Work, e):
+    if e is not None:
+        work.file.status = Status.Error
+        # one job failing, say a corrupt image or a model that can't be
+        # made, doesn't stop the others
+        msg(
+            "jobError",
+            file=work.file,
+            e=traceback.format_exception(type(e), e, e.__traceback__),
+        )
+        msg("update_file", file=work.file)
+    else:
+        # only incremental runs read the manifests, so only they pay for
+        # writing them
+        if work.settings.incremental:
+            work.session.manifests.record(
+                work.file.file, work.file.outfile, work.settings
+            )
+        work.file.status = Status.Done
+        msg("update_file", file=work.file)
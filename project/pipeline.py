@@ -0,0 +1,90 @@
+import traceback
+from dataclasses import dataclass
+from queue import Queue
+from threading import Lock, Thread
+
+
+@dataclass
+class Stage:
+    name: str
+    func: None
+    workers: int = 1
+    busy: int = 0
+
+
+class Pipeline:
+    def __init__(self, stages, queue_size=8):
+        self.stages = stages
+        # The intake is unbounded so that submit() never blocks the GUI thread;
+        # the queues between stages are bounded so a slow stage applies
+        # backpressure instead of letting decoded images pile up in memory.
+        self.queues = [Queue()] + [Queue(queue_size) for _ in stages[1:]]
+        self._lock = Lock()
+
+        for index, stage in enumerate(stages):
+            for n in range(stage.workers):
+                Thread(
+                    target=self._worker,
+                    args=(index,),
+                    name=f"{stage.name}-{n}",
+                    daemon=True,
+                ).start()
+
+    # nonblocking; callback(item, error) runs on a pipeline thread
+    def submit(self, item, callback):
+        self.queues[0].put((item, callback))
+
+    # stops every stage thread; work still in flight may be dropped, so only
+    # call this when nothing is queued
+    def shutdown(self):
+        for stage, queue in zip(self.stages, self.queues):
+            for _ in range(stage.workers):
+                queue.put(None)
+
+    def queue_depths(self):
+        return {
+            stage.name: queue.qsize() for stage, queue in zip(self.stages, self.queues)
+        }
+
+    def busy(self):
+        with self._lock:
+            return {stage.name: stage.busy for stage in self.stages}
+
+    def _worker(self, index):
+        stage = self.stages[index]
+        queue = self.queues[index]
+        last = index + 1 == len(self.stages)
+
+        while True:
+            entry = queue.get()
+            if entry is None:
+                return
+            item, callback = entry
+
+            with self._lock:
+                stage.busy += 1
+            try:
+                item = stage.func(item)
+            except Exception as e:
+                self._finish(item, callback, e)
+                continue
+            finally:
+                with self._lock:
+                    stage.busy -= 1
+
+            if last:
+                self._finish(item, callback, None)
+            else:
+                self.queues[index + 1].put((item, callback))
+
+    def _finish(self, item, callback, error):
+        # A callback that raises mustn't take the stage thread down with it.
+        # A failure on success is reported as the item's error; one while
+        # reporting an error can only be printed.
+        try:
+            callback(item, error)
+        except Exception as e:
+            if error is None:
+                self._finish(item, callback, e)
+            else:
+                traceback.print_exc()
@@ -0,0 +1,171 @@
+import io
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from PIL import Image
+
+import rembg
+import rembg.array
+import rembg.scheduler
+import rembg.session_factory
+
+from .render import compose, inference_resolution, load_image, save_image
+
+_plan = None
+
+
+def _init_worker(plan, counter):
+    global _plan
+    _plan = plan
+
+    # each worker takes the next set of cores, before any ORT pool exists
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    if plan.affinity:
+        rembg.scheduler.set_affinity(plan.affinity[index % len(plan.affinity)])
+
+
+def _worker_session(model_name, resolution=None):
+    # one session per model and resolution per worker process, created on
+    # first use
+    return rembg.get_session(
+        model_name,
+        intra_op_num_threads=_plan.intra_op_num_threads,
+        inter_op_num_threads=_plan.inter_op_num_threads,
+        resolution=resolution,
+    )
+
+
+def _predict_shared(
+    model_name, resolution, src_name, shape, dtype, dst_name, dst_shape
+):
+    # Pool workers share the parent's resource tracker, so attaching here
+    # doesn't hand ownership of the blocks to the worker; the parent unlinks.
+    src = SharedMemory(name=src_name)
+    dst = SharedMemory(name=dst_name)
+
+    image = img = out = None
+    try:
+        image = np.ndarray(shape, dtype, buffer=src.buf)
+        session = _worker_session(model_name, resolution)
+        # back to PIL, so preprocessing is the same as on the thread backend
+        img = Image.fromarray(image)
+        inputs = session.preprocess([img])
+        masks = session.decode_masks(session.run(inputs))[0]
+        if masks.shape != dst_shape:
+            # a fixed-size model that couldn't be made dynamic ran at its own
+            # resolution
+            masks = [rembg.array.resize(mask, dst_shape[:0:-1]) for mask in masks]
+
+        out = np.ndarray(dst_shape, np.uint8, buffer=dst.buf)
+        out[...] = masks
+    finally:
+        # views into the blocks must be gone before they can be closed
+        image = img = out = None
+        src.close()
+        dst.close()
+
+
+def _pixels(image):
+    # modes that survive Image.fromarray in the worker are sent as they are;
+    # the rest are converted the way preprocessing would convert them
+    if isinstance(image, np.ndarray):
+        return np.ascontiguousarray(image)
+    if image.mode not in ("L", "RGB", "RGBA"):
+        image = image.convert("RGB")
+    return np.asarray(image)
+
+
+class ProcessEngine:
+    # Inference runs in worker processes, each with its own sessions.
+    # Decoded pixels go to a worker and its masks come back through shared
+    # memory blocks owned by the parent, so neither is pickled. Decoding,
+    # compositing and encoding stay in the calling threads, as does the
+    # mask cache.
+    # The cores are split between the workers by rembg.scheduler, so that
+    # workers * ort_threads doesn't oversubscribe them; with affinity each
+    # worker is pinned to its own share. reserved is the number of the
+    # caller's busy threads to leave cores for.
+    def __init__(self, workers=None, ort_threads=None, affinity=False, reserved=0):
+        self.plan = rembg.scheduler.plan_threads(
+            workers, ort_threads, affinity=affinity, reserved=reserved
+        )
+        self.workers = self.plan.workers
+        self.ort_threads = self.plan.intra_op_num_threads
+        # spawn rather than fork: forking a process that already has ORT and
+        # numba thread pools running is not safe
+        context = multiprocessing.get_context("spawn")
+        self.pool = ProcessPoolExecutor(
+            self.workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self.plan, context.Value("i", 0)),
+        )
+
+    # The returned future resolves to the masks at model resolution, a
+    # (masks, resolution, resolution) uint8 array like one image's worth of
+    # BaseSession.decode_masks.
+    def submit_predict(self, image, model_name, resolution=None):
+        session_class = rembg.session_factory.models[model_name].session_class
+        resolution = resolution or session_class.default_resolution
+        image = _pixels(image)
+        dst_shape = (len(session_class.mask_names), resolution, resolution)
+
+        src = SharedMemory(create=True, size=max(image.nbytes, 1))
+        dst = SharedMemory(create=True, size=max(int(np.prod(dst_shape)), 1))
+        np.ndarray(image.shape, image.dtype, buffer=src.buf)[...] = image
+
+        result = Future()
+
+        def done(future):
+            try:
+                future.result()
+                masks = np.ndarray(dst_shape, np.uint8, buffer=dst.buf).copy()
+            except BaseException as e:
+                result.set_exception(e)
+            else:
+                result.set_result(masks)
+            finally:
+                for shm in (src, dst):
+                    shm.close()
+                    shm.unlink()
+
+        self.pool.submit(
+            _predict_shared,
+            model_name,
+            resolution,
+            src.name,
+            image.shape,
+            image.dtype.str,
+            dst.name,
+            dst_shape,
+        ).add_done_callback(done)
+
+        return result
+
+    # blocking; everything but inference runs on the calling thread
+    def render_file(self, infile, outfile, settings, mask_cache=None):
+        model_name = settings.model.name
+        resolution = inference_resolution(settings)
+
+        key = masks = None
+        if mask_cache is None:
+            image = load_image(infile)
+        else:
+            data, key, masks = mask_cache.lookup_file(infile, model_name, resolution)
+            image = load_image(io.BytesIO(data))
+
+        if masks is None:
+            masks = self.submit_predict(image, model_name, resolution).result()
+            if key is not None:
+                mask_cache.put(key, masks)
+
+        session_class = rembg.session_factory.models[model_name].session_class
+        masks = session_class.upscale_masks(image, masks)
+        save_image(compose(image, masks, settings), outfile, settings.encoder.name)
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
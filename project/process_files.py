@@ -1,49 +1,193 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
+from queue import Empty, Queue
+from threading import Thread
 
 from PIL import Image, UnidentifiedImageError
 
+DISCOVER_WORKERS = 16
+SNIFF_SIZE = 16
+SNIFF_CHUNK = 256
+
+# (offset, magic) pairs that must all match, for the common formats Pillow
+# reads; anything else is left to Pillow to identify
+SIGNATURES = [
+    ((0, b"\x89PNG\r\n\x1a\n"),),
+    ((0, b"\xff\xd8\xff"),),
+    ((0, b"GIF87a"),),
+    ((0, b"GIF89a"),),
+    ((0, b"BM"),),
+    ((0, b"II*\x00"),),
+    ((0, b"MM\x00*"),),
+    ((0, b"RIFF"), (8, b"WEBP")),
+    ((0, b"qoif"),),
+    ((4, b"ftypavif"),),
+    ((4, b"ftypavis"),),
+    ((0, b"\x00\x00\x00\x0cjP  \r\n\x87\n"),),
+    ((0, b"\xff\x4f\xff\x51"),),
+]
+
+
+def is_image(file):
+    # Common formats are told by their first few bytes, which is cheap even
+    # on network shares. Formats without a listed signature, like ICO, PPM
+    # or TGA, are opened by Pillow, which only reads their header.
+    try:
+        with open(file, "rb") as f:
+            head = f.read(SNIFF_SIZE)
+    except OSError:
+        return False
+
+    if any(
+        all(head.startswith(magic, offset) for offset, magic in signature)
+        for signature in SIGNATURES
+    ):
+        return True
+
+    try:
+        with Image.open(file):
+            return True
+    except (OSError, UnidentifiedImageError, NotImplementedError, ValueError):
+        return False
+
 
 def _open_files(files):
     for file in files:
         file = Path(file)
-        if not file.is_file():
-            continue
+        if file.is_file() and is_image(file):
+            yield file
+
+
+def _scan_dir(folder):
+    files = []
+    dirs = []
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif entry.is_file():
+                        files.append(Path(entry.path))
+                except OSError:
+                    pass
+    except OSError:
+        pass
+
+    files.sort()
+    return files, dirs
+
 
-        valid = False
+def _sniff(files):
+    return [file for file in files if is_image(file)]
 
+
+def walk_images(folder, workers=DISCOVER_WORKERS):
+    # Every directory is listed on the pool as soon as its parent has been,
+    # and the files found are sniffed there in chunks, so slow listings and
+    # reads overlap. Images are yielded as their chunk finishes; the order
+    # within a chunk is sorted, the order between chunks is not.
+    with ThreadPoolExecutor(workers) as pool:
+        scans = {pool.submit(_scan_dir, folder)}
+        sniffs = set()
+
+        while scans or sniffs:
+            done, _ = wait(scans | sniffs, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in scans:
+                    scans.remove(future)
+                    files, dirs = future.result()
+                    scans.update(pool.submit(_scan_dir, d) for d in dirs)
+                    for i in range(0, len(files), SNIFF_CHUNK):
+                        sniffs.add(pool.submit(_sniff, files[i : i + SNIFF_CHUNK]))
+                else:
+                    sniffs.remove(future)
+                    yield from future.result()
+
+
+class _End:
+    def __init__(self, error=None):
+        self.error = error
+
+
+def _feed(iterator, items):
+    try:
+        for item in iterator:
+            items.put(item)
+    except Exception as e:
+        items.put(_End(e))
+    else:
+        items.put(_End())
+
+
+def batched(iterator, size=512, interval=0.1):
+    # Lists of up to `size` items, cut early once `interval` seconds have
+    # passed since the batch started. The iterator runs on a thread of its
+    # own, so a batch is handed out on time even while it is still looking
+    # for the next item; its errors are raised here.
+    items = Queue()
+    Thread(target=_feed, args=(iterator, items), daemon=True).start()
+
+    batch = []
+    deadline = None
+    while True:
         try:
-            with Image.open(file):
-                valid = True
-        except (OSError, UnidentifiedImageError, NotImplementedError, ValueError):
-            pass
+            if batch:
+                item = items.get(timeout=max(0, deadline - time.monotonic()))
+            else:
+                item = items.get()
+        except Empty:
+            yield batch
+            batch = []
+            continue
 
-        if valid:
-            yield file
+        if isinstance(item, _End):
+            if batch:
+                yield batch
+            if item.error is not None:
+                raise item.error
+            return
+
+        if not batch:
+            deadline = time.monotonic() + interval
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
 
 
-def open_files(files):
+# skip(file, outfile) -> bool leaves out files whose output is up to date
+def open_files(files, output_dir=None, suffix=".png", skip=None):
     for file in _open_files(files):
         folder_processed = file.parent / "rembg"
-        outfile = folder_processed / file.relative_to(file.parent).with_suffix(".png")
-        yield file, outfile
+        if output_dir is not None:
+            folder_processed = Path(output_dir)
+        outfile = folder_processed / file.relative_to(file.parent).with_suffix(suffix)
+        if skip is None or not skip(file, outfile):
+            yield file, outfile
 
 
-def open_folder(folder):
+def open_folder(folder, output_dir=None, suffix=".png", skip=None):
     folder = Path(folder)
     if not folder.is_dir():
         return
 
     folder_processed = folder.with_name(folder.name + "_rembg")
+    if output_dir is not None:
+        folder_processed = Path(output_dir) / folder.name
 
-    for file in _open_files(folder.rglob("*")):
-        outfile = folder_processed / file.relative_to(folder).with_suffix(".png")
-        yield file, outfile
+    for file in walk_images(folder):
+        outfile = folder_processed / file.relative_to(folder).with_suffix(suffix)
+        if skip is None or not skip(file, outfile):
+            yield file, outfile
 
 
-def open_mixed(files):
+def open_mixed(files, output_dir=None, suffix=".png", skip=None):
     for file in files:
         file = Path(file)
         if file.is_file():
-            yield from open_files([file])
+            yield from open_files([file], output_dir, suffix, skip)
         elif file.is_dir():
-            yield from open_folder(file)
+            yield from open_folder(file, output_dir, suffix, skip)
@@ -0,0 +1,63 @@
+import io
+
+from PIL import Image
+
+import rembg
+import rembg.encoders
+import rembg.session_factory
+
+from .model import AlphaMatting
+
+
+def load_image(infile):
+    with Image.open(infile) as image:
+        image.load()
+    return image
+
+
+def compose(image, masks, settings):
+    # the background is blended in while cutting out; opaque colours give RGB
+    matting = settings.alpha_matting
+    return rembg.apply_masks(
+        image,
+        masks,
+        matting != AlphaMatting.off,
+        alpha_matting_mode=matting.name,
+        alpha_matting_max_pixels=settings.matting_max_pixels,
+        bgcolor=settings.bgcolor.value,
+    )
+
+
+def inference_resolution(settings):
+    # a multiple of 32, as the models halve their input five times
+    session_class = rembg.session_factory.models[settings.model.name].session_class
+    scaled = session_class.default_resolution * settings.resolution.value
+    return max(32, round(scaled / 32) * 32)
+
+
+def output_suffix(settings):
+    return rembg.encoders.get_encoder(settings.encoder.name).suffix
+
+
+def save_image(image, outfile, encoder="png"):
+    outfile.parent.mkdir(parents=True, exist_ok=True)
+    rembg.encoders.get_encoder(encoder).save(image, outfile)
+
+
+# model_session is made for inference_resolution(settings), and runs at its
+# own resolution if the model couldn't be made to run at that one
+def render_file(model_session, infile, outfile, settings, mask_cache=None):
+    if mask_cache is None:
+        image = load_image(infile)
+        masks = model_session.predict(image)
+    else:
+        data, key, masks = mask_cache.lookup_file(
+            infile, model_session.model_name, model_session.resolution
+        )
+        image = load_image(io.BytesIO(data))
+        if masks is None:
+            inputs = model_session.preprocess([image])
+            masks = model_session.decode_masks(model_session.run(inputs))[0]
+            mask_cache.put(key, masks)
+        masks = model_session.upscale_masks(image, masks)
+    save_image(compose(image, masks, settings), outfile, settings.encoder.name)
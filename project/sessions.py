@@ -0,0 +1,146 @@
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from threading import Lock
+
+import rembg.session_factory
+from rembg.session_base import BaseSession
+
+DEFAULT_MEMORY_BUDGET = 512 * 2**20
+DEFAULT_IDLE_TIMEOUT = 600
+
+
+@dataclass
+class _Entry:
+    session: BaseSession
+    size: int
+    last_used: float
+
+
+# bytes of activations ORT's arena holds per input pixel, a rough figure
+# for the U2Net family
+ACTIVATION_BYTES_PER_PIXEL = 1024
+
+
+def estimate_size(model_name, resolution=None):
+    # ORT keeps roughly one copy of the initializers resident, so the size of
+    # the .onnx file stands in for the weights; the activations grow with
+    # the square of the inference resolution.
+    if resolution is None:
+        session_class = rembg.session_factory.models[model_name].session_class
+        resolution = session_class.default_resolution
+    activations = ACTIVATION_BYTES_PER_PIXEL * resolution**2
+    try:
+        return rembg.session_factory.model_path(model_name).stat().st_size + activations
+    except OSError:
+        return activations
+
+
+class ModelSessions:
+    def __init__(
+        self,
+        memory_budget=DEFAULT_MEMORY_BUDGET,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT,
+        loader=rembg.session_factory.new_session,
+    ):
+        self.memory_budget = memory_budget
+        self.idle_timeout = idle_timeout
+        self.loader = loader
+
+        self._lock = Lock()
+        self._sessions = OrderedDict()
+        self._loading = {}
+
+    @property
+    def loading(self):
+        with self._lock:
+            return set(self._loading)
+
+    @property
+    def loaded(self):
+        with self._lock:
+            return list(self._sessions)
+
+    @property
+    def memory_used(self):
+        with self._lock:
+            return sum(entry.size for entry in self._sessions.values())
+
+    # blocking: loads the model on first use, waits if another thread is
+    # already loading it. Each inference resolution is a session of its own.
+    def get(self, model_name, resolution=None):
+        key = model_name if resolution is None else (model_name, resolution)
+        with self._lock:
+            self._evict_idle()
+
+            entry = self._sessions.get(key)
+            if entry is not None:
+                self._sessions.move_to_end(key)
+                entry.last_used = time.monotonic()
+                return entry.session
+
+            future = self._loading.get(key)
+            owner = future is None
+            if owner:
+                future = self._loading[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            if resolution is None:
+                session = self.loader(model_name)
+            else:
+                session = self.loader(model_name, resolution=resolution)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._loading[key]
+            self._sessions[key] = _Entry(
+                session, estimate_size(model_name, resolution), time.monotonic()
+            )
+            self._evict_over_budget()
+        future.set_result(session)
+
+        return session
+
+    # drops the model at every resolution
+    def release(self, model_name):
+        with self._lock:
+            for key in list(self._sessions):
+                if (key[0] if isinstance(key, tuple) else key) == model_name:
+                    del self._sessions[key]
+
+    # get() only evicts when it is called, so a session left idle is freed by
+    # calling this now and then
+    def evict_idle(self):
+        with self._lock:
+            self._evict_idle()
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    # Eviction only drops the cache's reference; a worker that is still
+    # running on an evicted session keeps it alive until it finishes.
+    def _evict_over_budget(self):
+        used = sum(entry.size for entry in self._sessions.values())
+        while used > self.memory_budget and len(self._sessions) > 1:
+            _, entry = self._sessions.popitem(last=False)
+            used -= entry.size
+
+    def _evict_idle(self):
+        if self.idle_timeout is None:
+            return
+
+        deadline = time.monotonic() - self.idle_timeout
+        while self._sessions:
+            name, entry = next(iter(self._sessions.items()))
+            if entry.last_used > deadline:
+                break
+            del self._sessions[name]
@@ -5,4 +5,11 @@ from . import _version
 
 __version__ = _version.get_versions()["version"]
 
-from .bg import remove
+from .bg import apply_masks, apply_masks_array, remove, remove_batch
+from .mask_cache import MaskCache
+from .session_factory import (
+    clear_sessions,
+    get_session,
+    new_session,
+    release_session,
+)
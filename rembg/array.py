@@ -0,0 +1,152 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+# Helpers for the ndarray path through remove(), which never converts to PIL.
+# Images are HxW (grey), HxWx2 (grey and alpha), HxWx3 (RGB) or HxWx4 (RGBA)
+# uint8 arrays.
+
+
+def to_rgb(img: np.ndarray) -> np.ndarray:
+    if img.ndim == 2:
+        return np.repeat(img[:, :, None], 3, axis=2)
+    if img.shape[2] < 3:
+        return np.repeat(img[:, :, :1], 3, axis=2)
+    if img.shape[2] == 3:
+        return img
+    return img[:, :, :3]
+
+
+def _alpha(img: np.ndarray) -> Optional[np.ndarray]:
+    # the image's own alpha channel, if it has one
+    if img.ndim == 3 and img.shape[2] in (2, 4):
+        return img[:, :, -1]
+    return None
+
+
+def _resize_axis(
+    ary: np.ndarray, n: int, axis: int
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    # the resized array, plus when downscaling the number of input pixels
+    # summed into each output pixel, for resize() to divide by
+    m = ary.shape[axis]
+    if n == m:
+        return ary, None
+
+    shape = [1] * ary.ndim
+    shape[axis] = n
+
+    if n < m:
+        # area average over the input rows that fall into each output row
+        edges = (np.arange(n) * m) // n
+        counts = np.diff(np.append(edges, m))
+        if ary.dtype == np.uint8 and counts.max() <= 257:
+            dtype = np.uint16
+        elif ary.dtype.kind in "ui":
+            dtype = np.uint32
+        else:
+            dtype = np.float32
+        sums = np.add.reduceat(ary, edges, axis=axis, dtype=dtype)
+        return sums, counts.reshape(shape)
+
+    # bilinear, sampling at pixel centres like PIL
+    pos = np.clip((np.arange(n) + 0.5) * (m / n) - 0.5, 0, m - 1)
+    lo = pos.astype(np.intp)
+    hi = np.minimum(lo + 1, m - 1)
+    t = (pos - lo).astype(np.float32).reshape(shape)
+
+    a = np.take(ary, lo, axis=axis).astype(np.float32)
+    a *= 1 - t
+    a += np.take(ary, hi, axis=axis) * t
+    return a, None
+
+
+def resize(img: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    # size is (width, height) like PIL. Downscaling averages areas and
+    # upscaling interpolates bilinearly. Columns go first so the pass over the
+    # full image reads uint8 and writes a narrow integer type; the area sums
+    # are divided once at the end, which commutes with the linear row pass.
+    out, col_counts = _resize_axis(img, size[0], 1)
+    out, row_counts = _resize_axis(out, size[1], 0)
+
+    if col_counts is not None or row_counts is not None:
+        counts = np.float32(1)
+        for c in (col_counts, row_counts):
+            if c is not None:
+                counts = counts * c.astype(np.float32)
+        out = out / counts
+
+    if out.dtype != np.uint8:
+        out = np.clip(out + 0.5, 0, 255).astype(np.uint8)
+    return out
+
+
+def naive_cutout(
+    img: np.ndarray, mask: np.ndarray, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    # Same result as the PIL naive_cutout: the image pasted over a transparent
+    # canvas through the mask, so every channel is scaled by mask / 255 with
+    # PIL's rounding. Written straight into `out`, an HxWx4 uint8 buffer.
+    if out is None:
+        out = np.empty((*mask.shape, 4), dtype=np.uint8)
+
+    rgb = to_rgb(img)
+    tmp = np.empty(mask.shape, dtype=np.uint16)
+
+    # one channel at a time keeps the uint16 temporary small and cache friendly
+    for c in range(3):
+        np.multiply(rgb[:, :, c], mask, out=tmp, dtype=np.uint16)
+        _blend_round(tmp, out[:, :, c])
+
+    alpha = _alpha(img)
+    if alpha is not None:
+        np.multiply(alpha, mask, out=tmp, dtype=np.uint16)
+        _blend_round(tmp, out[:, :, 3])
+    else:
+        out[:, :, 3] = mask
+
+    return out
+
+
+def composite(
+    img: np.ndarray,
+    mask: np.ndarray,
+    bg: np.ndarray,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    # The image over an opaque background through the mask in one pass,
+    # img * m + bg * (255 - m) over 255 with PIL's rounding, which is what
+    # pasting onto a background canvas gives. bg is an RGB colour or an HxWx3
+    # array, and the result is written into `out`, an HxWx3 uint8 buffer.
+    if out is None:
+        out = np.empty((*mask.shape, 3), dtype=np.uint8)
+
+    rgb = to_rgb(img)
+    tmp = np.empty(mask.shape, dtype=np.uint16)
+    tmp_bg = np.empty(mask.shape, dtype=np.uint16)
+
+    alpha = _alpha(img)
+    if alpha is not None:
+        np.multiply(alpha, mask, out=tmp, dtype=np.uint16)
+        mask = np.empty(mask.shape, dtype=np.uint8)
+        _blend_round(tmp, mask)
+    inverse = 255 - mask
+
+    for c in range(3):
+        np.multiply(rgb[:, :, c], mask, out=tmp, dtype=np.uint16)
+        if bg.ndim == 1:
+            np.multiply(inverse, np.uint16(bg[c]), out=tmp_bg, dtype=np.uint16)
+        else:
+            np.multiply(bg[:, :, c], inverse, out=tmp_bg, dtype=np.uint16)
+        tmp += tmp_bg
+        _blend_round(tmp, out[:, :, c])
+
+    return out
+
+
+def _blend_round(tmp: np.ndarray, out: np.ndarray) -> None:
+    # x * m / 255 rounded exactly the way PIL's BLEND macro does it
+    tmp += 128
+    tmp += tmp >> 8
+    tmp >>= 8
+    out[...] = tmp
@@ -1,17 +1,21 @@
 import io
 from enum import Enum
-from typing import List, Optional, Union
+from typing import List, Optional, Sequence, Tuple, Union
 
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageChops
 from PIL.Image import Image as PILImage
 from pymatting.alpha.estimate_alpha_cf import estimate_alpha_cf
 from pymatting.foreground.estimate_foreground_ml import estimate_foreground_ml
 from pymatting.util.util import stack_images
 from scipy.ndimage.morphology import binary_erosion
 
+from . import array
+from .encoders import Encoder, get_encoder
+from .mask_cache import MaskCache
+from .matting import estimate_band, guided_filter, upsample_cutout
 from .session_base import BaseSession
-from .session_factory import new_session
+from .session_factory import get_session
 
 
 class ReturnType(Enum):
@@ -26,7 +30,39 @@ def alpha_matting_cutout(
     foreground_threshold: int,
     background_threshold: int,
     erode_structure_size: int,
+    mode: str = "full",
+    max_pixels: Optional[int] = None,
 ) -> PILImage:
+    if mode not in ("full", "band"):
+        raise ValueError("Alpha matting mode {} is not supported.".format(mode))
+
+    if max_pixels is not None and img.width * img.height > max_pixels:
+        # Matte at a reduced scale and bring the result back up with a guided
+        # upsampler, so the closed-form solve never sees more than max_pixels.
+        img = img.convert("RGB")
+        scale = (max_pixels / (img.width * img.height)) ** 0.5
+        size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        if erode_structure_size > 0:
+            erode_structure_size = max(1, round(erode_structure_size * scale))
+
+        img_small = img.resize(size, Image.BOX)
+        cutout_small = alpha_matting_cutout(
+            img_small,
+            mask.resize(size, Image.BILINEAR),
+            foreground_threshold,
+            background_threshold,
+            erode_structure_size,
+            mode,
+        )
+
+        return Image.fromarray(
+            upsample_cutout(
+                np.asarray(img), np.asarray(img_small), np.asarray(cutout_small)
+            )
+        )
+
+    if mode == "band":
+        img = img.convert("RGB")
     img = np.asarray(img)
     mask = np.asarray(mask)
 
@@ -46,6 +82,11 @@ def alpha_matting_cutout(
     trimap[is_foreground] = 255
     trimap[is_background] = 0
 
+    if mode == "band":
+        alpha, foreground = estimate_band(img, trimap)
+        cutout = np.dstack((foreground, np.round(alpha * 255).astype(np.uint8)))
+        return Image.fromarray(cutout)
+
     img_normalized = img / 255.0
     trimap_normalized = trimap / 255.0
 
@@ -59,17 +100,77 @@ def alpha_matting_cutout(
     return cutout
 
 
+def guided_refine(img: PILImage, mask: PILImage) -> PILImage:
+    src = np.asarray(mask, dtype=np.float32) * np.float32(1 / 255)
+    alpha = guided_filter(np.asarray(img.convert("RGB")), src)
+    return Image.fromarray(np.clip(alpha * 255 + 0.5, 0, 255).astype(np.uint8))
+
+
 def naive_cutout(img: PILImage, mask: PILImage) -> PILImage:
     empty = Image.new("RGBA", (img.size), 0)
     cutout = Image.composite(img, empty, mask)
     return cutout
 
 
+Background = Optional[Tuple[int, ...]]
+BackgroundImage = Optional[Union[PILImage, np.ndarray]]
+
+
+def _check_background(bgcolor: Background, bgimage: BackgroundImage) -> None:
+    if bgcolor is not None and bgimage is not None:
+        raise ValueError("Pass either a background colour or a background image.")
+
+
+def _opaque_background(bgcolor: Background, bgimage: BackgroundImage) -> bool:
+    # background images are always used as opaque RGB
+    if bgimage is not None:
+        return True
+    return bgcolor is not None and (len(bgcolor) == 3 or bgcolor[3] == 255)
+
+
+def background_cutout(
+    img: PILImage,
+    mask: PILImage,
+    bgcolor: Background = None,
+    bgimage: BackgroundImage = None,
+) -> PILImage:
+    # The standard "over" blend, img * a + bg * (1 - a), with the image's own
+    # alpha (if any) times the mask as a. An opaque background is a canvas the
+    # image is pasted into through the mask, giving an RGB image in one pass.
+    if img.mode == "RGBA":
+        mask = ImageChops.multiply(mask, img.getchannel("A"))
+
+    if _opaque_background(bgcolor, bgimage):
+        if bgimage is None:
+            canvas = Image.new("RGB", img.size, tuple(bgcolor[:3]))
+        else:
+            if isinstance(bgimage, np.ndarray):
+                bgimage = Image.fromarray(bgimage)
+            canvas = bgimage.convert("RGB")
+            if canvas.size != img.size:
+                canvas = canvas.resize(img.size, Image.BILINEAR)
+        canvas.paste(img.convert("RGB"), mask=mask)
+        return canvas
+
+    cutout = img.convert("RGBA")
+    cutout.putalpha(mask)
+    if bgcolor is None or bgcolor[3] == 0:
+        return cutout
+    return Image.alpha_composite(Image.new("RGBA", img.size, tuple(bgcolor)), cutout)
+
+
 def get_concat_v_multi(imgs: List[PILImage]) -> PILImage:
-    pivot = imgs.pop(0)
+    # one canvas for all of them rather than a taller copy per image
+    if len(imgs) == 1:
+        return imgs[0]
+
+    mode = "RGB" if all(im.mode == "RGB" for im in imgs) else "RGBA"
+    dst = Image.new(mode, (max(im.width for im in imgs), sum(im.height for im in imgs)))
+    top = 0
     for im in imgs:
-        pivot = get_concat_v(pivot, im)
-    return pivot
+        dst.paste(im, (0, top))
+        top += im.height
+    return dst
 
 
 def get_concat_v(img1: PILImage, img2: PILImage) -> PILImage:
@@ -79,35 +180,110 @@ def get_concat_v(img1: PILImage, img2: PILImage) -> PILImage:
     return dst
 
 
-def remove(
-    data: Union[bytes, PILImage, np.ndarray],
-    alpha_matting: bool = False,
-    alpha_matting_foreground_threshold: int = 240,
-    alpha_matting_background_threshold: int = 10,
-    alpha_matting_erode_size: int = 10,
-    session: Optional[BaseSession] = None,
-    only_mask: bool = False,
-) -> Union[bytes, PILImage, np.ndarray]:
+MASK_LAYOUTS = ("concat", "list", "stack")
+
+
+def _check_layout(mask_layout: str) -> None:
+    if mask_layout not in MASK_LAYOUTS:
+        raise ValueError("Mask layout {} is not supported.".format(mask_layout))
+
+
+def _stack_shape(
+    height: int, width: int, count: int, channels: Optional[int]
+) -> Tuple[int, ...]:
+    # channels is None for bare masks
+    if channels is None:
+        return (count, height, width)
+    return (count, height, width, channels)
+
+
+def _output_channels(
+    only_mask: bool, bgcolor: Background, bgimage: BackgroundImage
+) -> Optional[int]:
+    if only_mask:
+        return None
+    return 3 if _opaque_background(bgcolor, bgimage) else 4
 
+
+def _out_shapes(
+    img: np.ndarray,
+    count: int,
+    channels: Optional[int],
+    only_mask: bool,
+    mask_layout: str,
+) -> List[Tuple[int, ...]]:
+    # the shapes an `out` buffer for apply_masks_array may have, the one it
+    # allocates first
+    height, width = img.shape[:2]
+    if mask_layout != "concat":
+        return [_stack_shape(height, width, count, channels)]
+    if count == 0:
+        return [img.shape]
+    if only_mask and count == 1:
+        return [(height, width)]
+
+    channels = channels or 4
+    return [(height * count, width, channels), (count, height, width, channels)]
+
+
+def _load_image(
+    data: Union[bytes, PILImage, np.ndarray],
+) -> Tuple[Union[PILImage, np.ndarray], ReturnType]:
     if isinstance(data, PILImage):
-        return_type = ReturnType.PILLOW
-        img = data
+        return data, ReturnType.PILLOW
     elif isinstance(data, bytes):
-        return_type = ReturnType.BYTES
-        img = Image.open(io.BytesIO(data))
+        return Image.open(io.BytesIO(data)), ReturnType.BYTES
     elif isinstance(data, np.ndarray):
-        return_type = ReturnType.NDARRAY
-        img = Image.fromarray(data)
+        return data, ReturnType.NDARRAY
     else:
         raise ValueError("Input type {} is not supported.".format(type(data)))
 
-    if session is None:
-        session = new_session("u2net")
 
-    masks = session.predict(img)
+def apply_masks(
+    img: PILImage,
+    masks: List[PILImage],
+    alpha_matting: bool = False,
+    alpha_matting_foreground_threshold: int = 240,
+    alpha_matting_background_threshold: int = 10,
+    alpha_matting_erode_size: int = 10,
+    only_mask: bool = False,
+    *,
+    alpha_matting_mode: str = "full",
+    alpha_matting_max_pixels: Optional[int] = None,
+    refine: Optional[str] = None,
+    mask_layout: str = "concat",
+    bgcolor: Background = None,
+    bgimage: BackgroundImage = None,
+) -> Union[PILImage, List[PILImage], np.ndarray]:
+    # mask_layout picks how several masks come back: "concat" stacks the
+    # cutouts vertically in one image, "list" returns one image per mask and
+    # "stack" a single (masks, height, width[, channels]) uint8 array.
+    # With bgcolor or bgimage the cutouts are composited onto that background
+    # (see background_cutout).
+    if refine not in (None, "guided"):
+        raise ValueError("Refine mode {} is not supported.".format(refine))
+    _check_layout(mask_layout)
+    _check_background(bgcolor, bgimage)
+
+    has_background = bgcolor is not None or bgimage is not None
+    channels = _output_channels(only_mask, bgcolor, bgimage)
+
+    def cutout_of(img, mask):
+        if has_background:
+            return background_cutout(img, mask, bgcolor, bgimage)
+        return naive_cutout(img, mask)
+
     cutouts = []
+    stack = None
+    if mask_layout == "stack":
+        stack = np.empty(
+            _stack_shape(img.height, img.width, len(masks), channels), np.uint8
+        )
 
     for mask in masks:
+        if refine == "guided":
+            mask = guided_refine(img, mask)
+
         if only_mask:
             cutout = mask
 
@@ -119,27 +295,315 @@ def remove(
                     alpha_matting_foreground_threshold,
                     alpha_matting_background_threshold,
                     alpha_matting_erode_size,
+                    alpha_matting_mode,
+                    alpha_matting_max_pixels,
                 )
             except ValueError:
-                cutout = naive_cutout(img, mask)
+                cutout = cutout_of(img, mask)
+            else:
+                if has_background:
+                    cutout = background_cutout(
+                        cutout.convert("RGB"), cutout.getchannel("A"), bgcolor, bgimage
+                    )
 
         else:
-            cutout = naive_cutout(img, mask)
+            cutout = cutout_of(img, mask)
 
+        if stack is not None:
+            mode = "RGB" if channels == 3 else "RGBA"
+            stack[len(cutouts)] = np.asarray(
+                cutout if only_mask else cutout.convert(mode)
+            )
         cutouts.append(cutout)
 
+    if mask_layout == "list":
+        return cutouts
+    if mask_layout == "stack":
+        return stack
+
     cutout = img
     if len(cutouts) > 0:
         cutout = get_concat_v_multi(cutouts)
 
-    if ReturnType.PILLOW == return_type:
+    return cutout
+
+
+def apply_masks_array(
+    img: np.ndarray,
+    masks: List[np.ndarray],
+    alpha_matting: bool = False,
+    alpha_matting_foreground_threshold: int = 240,
+    alpha_matting_background_threshold: int = 10,
+    alpha_matting_erode_size: int = 10,
+    only_mask: bool = False,
+    *,
+    alpha_matting_mode: str = "full",
+    alpha_matting_max_pixels: Optional[int] = None,
+    refine: Optional[str] = None,
+    out: Optional[np.ndarray] = None,
+    mask_layout: str = "concat",
+    bgcolor: Background = None,
+    bgimage: BackgroundImage = None,
+) -> Union[np.ndarray, List[np.ndarray]]:
+    if refine not in (None, "guided"):
+        raise ValueError("Refine mode {} is not supported.".format(refine))
+    _check_layout(mask_layout)
+    _check_background(bgcolor, bgimage)
+
+    channels = _output_channels(only_mask, bgcolor, bgimage)
+    height, width = img.shape[:2]
+    shapes = _out_shapes(img, len(masks), channels, only_mask, mask_layout)
+    if out is not None and (out.dtype != np.uint8 or out.shape not in shapes):
+        raise ValueError("out must be a uint8 array of shape {}.".format(shapes[0]))
+
+    # pymatting's solvers and translucent backgrounds are only wired up for
+    # the PIL path
+    if (alpha_matting and not only_mask) or (bgcolor is not None and channels == 4):
+        cutout = apply_masks(
+            Image.fromarray(img),
+            [Image.fromarray(mask) for mask in masks],
+            alpha_matting,
+            alpha_matting_foreground_threshold,
+            alpha_matting_background_threshold,
+            alpha_matting_erode_size,
+            only_mask,
+            alpha_matting_mode=alpha_matting_mode,
+            alpha_matting_max_pixels=alpha_matting_max_pixels,
+            refine=refine,
+            mask_layout=mask_layout,
+            bgcolor=bgcolor,
+            bgimage=bgimage,
+        )
+        if mask_layout == "list":
+            cutout = [np.asarray(c) for c in cutout]
+            if out is None:
+                return cutout
+            cutout = np.stack(cutout) if cutout else np.empty(out.shape, np.uint8)
+        else:
+            cutout = np.asarray(cutout)
+            if out is None:
+                return cutout
+
+        out[...] = cutout.reshape(out.shape)
+        return list(out) if mask_layout == "list" else out
+
+    if len(masks) == 0 and mask_layout == "concat":
+        if out is None:
+            return img
+        out[...] = img
+        return out
+
+    if refine == "guided":
+        rgb = array.to_rgb(img)
+        masks = [
+            np.clip(
+                guided_filter(rgb, mask * np.float32(1 / 255)) * 255 + 0.5, 0, 255
+            ).astype(np.uint8)
+            for mask in masks
+        ]
+
+    if channels == 3:
+        if bgimage is None:
+            background = np.asarray(bgcolor[:3], dtype=np.uint8)
+        else:
+            if not isinstance(bgimage, np.ndarray):
+                bgimage = np.asarray(bgimage.convert("RGB"))
+            background = array.resize(array.to_rgb(bgimage), (width, height))
+
+    def cutout_into(mask, dst):
+        if channels == 3:
+            array.composite(img, mask, background, dst)
+        else:
+            array.naive_cutout(img, mask, dst)
+
+    if mask_layout == "concat" and only_mask and len(masks) == 1:
+        if out is None:
+            return masks[0]
+        out[...] = masks[0]
+        return out
+
+    if out is None:
+        out = np.empty(shapes[0], dtype=np.uint8)
+
+    if mask_layout != "concat":
+        # every layout other than concat is backed by one (masks, H, W[, C])
+        # buffer; "list" hands out its slices
+        for dst, mask in zip(out, masks):
+            if only_mask:
+                dst[...] = mask
+            else:
+                cutout_into(mask, dst)
+
+        return list(out) if mask_layout == "list" else out
+
+    # Stacked vertically like get_concat_v_multi, but into one buffer. Several
+    # masks on their own come out as opaque grey RGBA, as they do through PIL.
+    # A (masks, H, W, C) buffer is accepted too and filled in the same order.
+    if out.ndim == 4:
+        dsts = out
+    else:
+        dsts = [out[i * height : (i + 1) * height] for i in range(len(masks))]
+
+    for dst, mask in zip(dsts, masks):
+        if only_mask:
+            dst[:, :, :3] = mask[:, :, None]
+            dst[:, :, 3] = 255
+        else:
+            cutout_into(mask, dst)
+
+    return out
+
+
+def _convert_output(
+    cutout: Union[PILImage, np.ndarray, List[PILImage], List[np.ndarray]],
+    return_type: ReturnType,
+    encoder: Encoder = get_encoder("png"),
+) -> Union[bytes, PILImage, np.ndarray, List[Union[bytes, PILImage, np.ndarray]]]:
+    if isinstance(cutout, list):
+        return [_convert_output(c, return_type, encoder) for c in cutout]
+
+    # a stacked layout is an ndarray whatever the input was
+    if ReturnType.PILLOW == return_type or isinstance(cutout, np.ndarray):
         return cutout
 
-    if ReturnType.NDARRAY == return_type:
-        return np.asarray(cutout)
+    return encoder.encode(cutout)
+
+
+def remove(
+    data: Union[bytes, PILImage, np.ndarray],
+    alpha_matting: bool = False,
+    alpha_matting_foreground_threshold: int = 240,
+    alpha_matting_background_threshold: int = 10,
+    alpha_matting_erode_size: int = 10,
+    session: Optional[BaseSession] = None,
+    only_mask: bool = False,
+    *,
+    alpha_matting_mode: str = "full",
+    alpha_matting_max_pixels: Optional[int] = None,
+    refine: Optional[str] = None,
+    out: Optional[np.ndarray] = None,
+    mask_layout: str = "concat",
+    classes: Optional[Sequence[str]] = None,
+    encoder: Union[str, Encoder] = "png",
+    bgcolor: Background = None,
+    bgimage: BackgroundImage = None,
+    mask_cache: Optional[MaskCache] = None,
+    resolution: Optional[int] = None,
+) -> Union[bytes, PILImage, np.ndarray, list]:
+    return remove_batch(
+        [data],
+        alpha_matting=alpha_matting,
+        alpha_matting_foreground_threshold=alpha_matting_foreground_threshold,
+        alpha_matting_background_threshold=alpha_matting_background_threshold,
+        alpha_matting_erode_size=alpha_matting_erode_size,
+        alpha_matting_mode=alpha_matting_mode,
+        alpha_matting_max_pixels=alpha_matting_max_pixels,
+        refine=refine,
+        session=session,
+        only_mask=only_mask,
+        out=None if out is None else [out],
+        mask_layout=mask_layout,
+        classes=classes,
+        encoder=encoder,
+        bgcolor=bgcolor,
+        bgimage=bgimage,
+        mask_cache=mask_cache,
+        resolution=resolution,
+    )[0]
+
+
+def remove_batch(
+    datas: Sequence[Union[bytes, PILImage, np.ndarray]],
+    alpha_matting: bool = False,
+    alpha_matting_foreground_threshold: int = 240,
+    alpha_matting_background_threshold: int = 10,
+    alpha_matting_erode_size: int = 10,
+    session: Optional[BaseSession] = None,
+    only_mask: bool = False,
+    *,
+    alpha_matting_mode: str = "full",
+    alpha_matting_max_pixels: Optional[int] = None,
+    refine: Optional[str] = None,
+    out: Optional[Sequence[np.ndarray]] = None,
+    mask_layout: str = "concat",
+    classes: Optional[Sequence[str]] = None,
+    encoder: Union[str, Encoder] = "png",
+    bgcolor: Background = None,
+    bgimage: BackgroundImage = None,
+    mask_cache: Optional[MaskCache] = None,
+    resolution: Optional[int] = None,
+) -> List[Union[bytes, PILImage, np.ndarray, list]]:
+    # ndarray inputs stay ndarrays from preprocessing to the returned cutout,
+    # written into the matching `out` buffer when one is given. `classes`
+    # names the session masks to keep (see BaseSession.mask_names); the rest
+    # are never upscaled or composited. `encoder` (see rembg.encoders) is used
+    # for bytes input, which is returned as encoded bytes. With an RGB(A)
+    # bgcolor or a bgimage the result is composited onto it in the same pass,
+    # and comes out RGB when the background is opaque. With a mask_cache the
+    # model only runs for inputs it hasn't seen, so changing nothing but the
+    # compositing parameters costs a composite. `resolution` overrides the
+    # session's inference resolution for this call.
+    _check_layout(mask_layout)
+    _check_background(bgcolor, bgimage)
+    encoder = get_encoder(encoder)
+    if len(datas) == 0:
+        return []
+    loaded = [_load_image(data) for data in datas]
+
+    if out is not None:
+        if len(out) != len(loaded):
+            raise ValueError("out must have one buffer per input.")
+        if any(t != ReturnType.NDARRAY for _, t in loaded):
+            raise ValueError("out is only supported for ndarray input.")
+
+    if session is None:
+        session = get_session("u2net")
+
+    imgs = [img for img, _ in loaded]
+    if mask_cache is None:
+        batch_masks = session.predict_batch(imgs, classes, resolution)
+    else:
+        batch_masks = mask_cache.predict_batch(
+            session, imgs, datas, classes, resolution
+        )
 
-    bio = io.BytesIO()
-    cutout.save(bio, "PNG")
-    bio.seek(0)
+    cutouts = []
 
-    return bio.read()
+    for i, ((img, return_type), masks) in enumerate(zip(loaded, batch_masks)):
+        if return_type == ReturnType.NDARRAY:
+            cutout = apply_masks_array(
+                img,
+                masks,
+                alpha_matting,
+                alpha_matting_foreground_threshold,
+                alpha_matting_background_threshold,
+                alpha_matting_erode_size,
+                only_mask,
+                alpha_matting_mode=alpha_matting_mode,
+                alpha_matting_max_pixels=alpha_matting_max_pixels,
+                refine=refine,
+                out=None if out is None else out[i],
+                mask_layout=mask_layout,
+                bgcolor=bgcolor,
+                bgimage=bgimage,
+            )
+        else:
+            cutout = apply_masks(
+                img,
+                masks,
+                alpha_matting,
+                alpha_matting_foreground_threshold,
+                alpha_matting_background_threshold,
+                alpha_matting_erode_size,
+                only_mask,
+                alpha_matting_mode=alpha_matting_mode,
+                alpha_matting_max_pixels=alpha_matting_max_pixels,
+                refine=refine,
+                mask_layout=mask_layout,
+                bgcolor=bgcolor,
+                bgimage=bgimage,
+            )
+
+        cutouts.append(_convert_output(cutout, return_type, encoder))
+
+    return cutouts
@@ -0,0 +1,142 @@
+import io
+import threading
+import time
+from typing import IO, Dict, Iterable, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+from PIL.Image import Image as PILImage
+
+Picture = Union[PILImage, np.ndarray]
+
+
+class EncoderTimings:
+    # Cumulative encode time per encoder, safe to share between threads.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings: Dict[str, Tuple[int, float]] = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            count, total = self._timings.get(name, (0, 0.0))
+            self._timings[name] = (count + 1, total + seconds)
+
+    def snapshot(self) -> Dict[str, Tuple[int, float]]:
+        # {name: (images encoded, total seconds)}
+        with self._lock:
+            return dict(self._timings)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._timings.clear()
+
+
+# every encode in the process is counted here unless given other timings
+_timings = EncoderTimings()
+
+
+class Encoder(NamedTuple):
+    name: str
+    format: str
+    suffix: str
+    options: Dict[str, object] = {}
+    opaque_only: bool = False
+
+    def encode(self, img: Picture, timings: Optional[EncoderTimings] = None) -> bytes:
+        bio = io.BytesIO()
+        self.save(img, bio, timings)
+        return bio.getvalue()
+
+    def save(
+        self,
+        img: Picture,
+        fp: Union[str, IO[bytes]],
+        timings: Optional[EncoderTimings] = None,
+    ) -> None:
+        start = time.perf_counter()
+
+        if self.format == "NPY":
+            # raw RGBA pixels; the .npy header carries the shape and dtype
+            np.save(fp, np.asarray(img), allow_pickle=False)
+        else:
+            if isinstance(img, np.ndarray):
+                img = Image.fromarray(img)
+            if self.opaque_only:
+                img = _flatten(img, self.name)
+            img.save(fp, self.format, **self.options)
+
+        (timings or _timings).record(self.name, time.perf_counter() - start)
+
+
+encoders = {
+    # Pillow's defaults, which is what remove() has always produced
+    "png": Encoder("png", "PNG", ".png"),
+    "png_fast": Encoder("png_fast", "PNG", ".png", {"compress_level": 1}),
+    "png_optimize": Encoder("png_optimize", "PNG", ".png", {"optimize": True}),
+    "webp_lossless": Encoder(
+        "webp_lossless", "WEBP", ".webp", {"lossless": True, "method": 0}
+    ),
+    "npy": Encoder("npy", "NPY", ".npy"),
+    "jpeg": Encoder("jpeg", "JPEG", ".jpg", {"quality": 95}, opaque_only=True),
+}
+
+
+def get_encoder(encoder: Union[str, Encoder]) -> Encoder:
+    if isinstance(encoder, Encoder):
+        return encoder
+
+    try:
+        return encoders[encoder]
+    except KeyError:
+        raise ValueError(
+            "Encoder {} is not supported; choose from {}.".format(
+                encoder, list(encoders)
+            )
+        ) from None
+
+
+def _flatten(img: PILImage, name: str) -> PILImage:
+    if img.mode == "RGBA" and img.getextrema()[3][0] != 255:
+        raise ValueError(
+            "Encoder {} can't store transparency; use an opaque "
+            "background.".format(name)
+        )
+
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    return img
+
+
+def encoder_timings() -> Dict[str, Tuple[int, float]]:
+    # {name: (images encoded, total seconds)} across every thread
+    return _timings.snapshot()
+
+
+def reset_encoder_timings() -> None:
+    _timings.clear()
+
+
+def benchmark_encoders(
+    img: Picture, names: Optional[Iterable[str]] = None, repeat: int = 3
+) -> Dict[str, Tuple[float, int]]:
+    # {name: (best seconds per encode, encoded size in bytes)} for one image;
+    # encoders that can't store the image, like JPEG with transparency, are
+    # left out. Encodes are counted in timings of their own, so they don't
+    # show up in encoder_timings().
+    results = {}
+    timings = EncoderTimings()
+
+    for name in names or encoders:
+        encoder = get_encoder(name)
+        best = None
+        try:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                data = encoder.encode(img, timings)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+        except ValueError:
+            continue
+        results[name] = (best, len(data))
+
+    return results
@@ -0,0 +1,34 @@
+from pathlib import Path
+
+
+def make_dynamic(source: Path, target: Path) -> None:
+    # Copies the model with the batch size, height and width of its image
+    # inputs and outputs made symbolic, so it can run at other resolutions
+    # and on stacked batches. Shapes that
+    # were inferred for the tensors in between are dropped, as they no longer
+    # hold; ORT infers them again. A graph that computes sizes from constants
+    # rather than from its input still only runs at the size it was exported
+    # at, and has to be exported again.
+    try:
+        import onnx
+    except ImportError as e:
+        raise ImportError(
+            "Running a model at another resolution than it was exported at "
+            "needs the onnx package; install it with `pip install onnx`."
+        ) from e
+
+    model = onnx.load(str(source))
+    graph = model.graph
+    initializers = {init.name for init in graph.initializer}
+
+    for value in [*graph.input, *graph.output]:
+        if value.name in initializers:
+            continue
+        dims = value.type.tensor_type.shape.dim
+        if len(dims) == 4:
+            dims[0].dim_param = "batch"
+            dims[2].dim_param = "height"
+            dims[3].dim_param = "width"
+
+    del graph.value_info[:]
+    onnx.save(model, str(target))
@@ -0,0 +1,292 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from PIL.Image import Image as PILImage
+
+from .session_base import BaseSession
+from .session_factory import u2net_home
+
+DEFAULT_MEMORY_BUDGET = 256 * 2**20
+DEFAULT_DISK_BUDGET = 2 * 2**30
+# how often, in seconds, a cache rescans its directory for files written by
+# other processes
+RESCAN_INTERVAL = 30
+
+
+def default_cache_dir() -> Path:
+    return u2net_home() / "masks"
+
+
+def content_key(
+    data: Union[bytes, PILImage, np.ndarray],
+    model_name: str,
+    resolution: Optional[int] = None,
+) -> str:
+    # Encoded input is hashed as is; decoded images are hashed by their
+    # pixels plus the shape, so equal content gives equal keys. Masks from
+    # another inference resolution are different masks.
+    hashing = hashlib.blake2b(model_name.encode(), digest_size=20)
+    if resolution is not None:
+        hashing.update(f"@{resolution}".encode())
+
+    if isinstance(data, bytes):
+        hashing.update(data)
+    elif isinstance(data, np.ndarray):
+        hashing.update(repr((data.shape, data.dtype.str)).encode())
+        hashing.update(np.ascontiguousarray(data).data)
+    else:
+        hashing.update(repr((data.mode, data.size)).encode())
+        hashing.update(data.tobytes())
+
+    return hashing.hexdigest()
+
+
+@contextmanager
+def _file_lock(path: Path) -> Iterator[None]:
+    # an exclusive lock on `path`, held across processes
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+
+            f.seek(0)
+            # retries for about ten seconds, then raises OSError
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class MaskCache:
+    # Model masks at model resolution, (masks, height, width) uint8 as
+    # returned by BaseSession.decode_masks, kept in a memory LRU in front of
+    # a directory of .npy files with its own LRU by mtime. Either tier is
+    # bounded by its budget in bytes; a disk budget of 0 keeps it in memory.
+    # Several processes may share the directory. Each only estimates its
+    # size; the files are counted and evicted again from the directory
+    # itself, under a lock file, whenever the estimate goes over budget and
+    # at least every RESCAN_INTERVAL seconds.
+    def __init__(
+        self,
+        path: Optional[Union[str, Path]] = None,
+        memory_budget: int = DEFAULT_MEMORY_BUDGET,
+        disk_budget: int = DEFAULT_DISK_BUDGET,
+    ):
+        self.path = Path(path) if path is not None else default_cache_dir()
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._memory_used = 0
+        self._disk_used: Optional[int] = None
+        self._last_scan = 0.0
+
+    def key(
+        self,
+        data: Union[bytes, PILImage, np.ndarray],
+        model_name: str,
+        resolution: Optional[int] = None,
+    ) -> str:
+        return content_key(data, model_name, resolution)
+
+    def lookup_file(
+        self,
+        path: Union[str, Path],
+        model_name: str,
+        resolution: Optional[int] = None,
+    ) -> Tuple[bytes, str, Optional[np.ndarray]]:
+        # Masks for an image file are keyed on its bytes, which are at hand
+        # before decoding. Returns the bytes to decode, the key to put() the
+        # masks under if they have to be made, and the masks if cached.
+        with open(path, "rb") as f:
+            data = f.read()
+        key = self.key(data, model_name, resolution)
+        return data, key, self.get(key)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            masks = self._memory.get(key)
+            if masks is not None:
+                self._memory.move_to_end(key)
+                return masks
+
+        if self.disk_budget <= 0:
+            return None
+
+        # another process may have written or evicted it, so the directory
+        # is asked rather than an index
+        path = self._file(key)
+        try:
+            masks = np.load(path, allow_pickle=False)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        masks.flags.writeable = False
+
+        with self._lock:
+            self._remember(key, masks)
+        return masks
+
+    def put(self, key: str, masks: np.ndarray) -> None:
+        # a read-only copy, so neither the caller nor later readers can
+        # change what is cached
+        masks = np.array(masks, dtype=np.uint8, order="C")
+        masks.flags.writeable = False
+
+        with self._lock:
+            self._remember(key, masks)
+        if self.disk_budget <= 0:
+            return
+
+        path = self._file(key)
+        if path.is_file():
+            return
+
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(tmp, "wb") as f:
+                np.save(f, masks, allow_pickle=False)
+            os.replace(tmp, path)
+            size = path.stat().st_size
+        except OSError:
+            tmp.unlink(missing_ok=True)
+            return
+
+        with self._lock:
+            if self._disk_used is not None:
+                self._disk_used += size
+            due = (
+                self._disk_used is None
+                or self._disk_used > self.disk_budget
+                or time.monotonic() - self._last_scan >= RESCAN_INTERVAL
+            )
+        if due:
+            self._evict_disk()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._memory_used = 0
+
+        try:
+            with self._locked():
+                for _, path, _ in self._scan():
+                    try:
+                        path.unlink(missing_ok=True)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+        with self._lock:
+            self._disk_used = 0
+
+    def predict_batch(
+        self,
+        session: BaseSession,
+        imgs: Sequence[Union[PILImage, np.ndarray]],
+        datas: Optional[Sequence[Union[bytes, PILImage, np.ndarray]]] = None,
+        classes: Optional[Sequence[str]] = None,
+        resolution: Optional[int] = None,
+    ) -> List[list]:
+        # Same result as session.predict_batch, with the model only run for
+        # the images that aren't cached. `datas` are what the keys are made
+        # from, the encoded bytes for instance, and default to the images.
+        resolution = resolution or session.resolution
+        keys = [
+            self.key(data, session.model_name, resolution) for data in (datas or imgs)
+        ]
+        raw = [self.get(key) for key in keys]
+
+        missing = [i for i, masks in enumerate(raw) if masks is None]
+        if missing:
+            inputs = session.preprocess(
+                [imgs[i] for i in missing], resolution=resolution
+            )
+            decoded = session.decode_masks(session.run(inputs))
+            for i, masks in zip(missing, decoded):
+                self.put(keys[i], masks)
+                raw[i] = masks
+
+        selected = session.select_masks(classes)
+        return [
+            session.upscale_masks(img, masks[selected]) for img, masks in zip(imgs, raw)
+        ]
+
+    def _file(self, key: str) -> Path:
+        return self.path / f"{key}.npy"
+
+    def _remember(self, key: str, masks: np.ndarray) -> None:
+        if key not in self._memory:
+            self._memory_used += masks.nbytes
+        self._memory[key] = masks
+        self._memory.move_to_end(key)
+
+        while self._memory_used > self.memory_budget and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= evicted.nbytes
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        self.path.mkdir(parents=True, exist_ok=True)
+        with _file_lock(self.path / ".lock"):
+            yield
+
+    def _scan(self) -> List[Tuple[int, Path, int]]:
+        # (mtime, path, size) of every cached file, least recently used first
+        entries = []
+        try:
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if entry.name.endswith(".npy"):
+                        try:
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        entries.append((st.st_mtime_ns, Path(entry.path), st.st_size))
+        except OSError:
+            pass
+
+        entries.sort()
+        return entries
+
+    def _evict_disk(self) -> None:
+        # the oldest files go first, whichever process wrote them; the newest
+        # one is always kept
+        try:
+            with self._locked():
+                entries = self._scan()
+                used = sum(size for _, _, size in entries)
+                for _, path, size in entries[:-1]:
+                    if used <= self.disk_budget:
+                        break
+                    try:
+                        path.unlink(missing_ok=True)
+                    except OSError:
+                        # open in another process, on Windows
+                        continue
+                    used -= size
+        except OSError:
+            return
+
+        with self._lock:
+            self._disk_used = used
+            self._last_scan = time.monotonic()
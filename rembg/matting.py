@@ -0,0 +1,186 @@
+from typing import Tuple
+
+import numpy as np
+from PIL import Image
+from pymatting.alpha.estimate_alpha_cf import estimate_alpha_cf
+from pymatting.foreground.estimate_foreground_ml import estimate_foreground_ml
+from scipy.ndimage import find_objects, label, uniform_filter
+
+
+def _tiles(box: Tuple[slice, slice], shape, tile_size: int, margin: int):
+    # Split a component's bounding box into cells of at most tile_size pixels
+    # and pair each cell with a crop grown by margin on every side.
+    for y in range(box[0].start, box[0].stop, tile_size):
+        for x in range(box[1].start, box[1].stop, tile_size):
+            cell = (
+                slice(y, min(y + tile_size, box[0].stop)),
+                slice(x, min(x + tile_size, box[1].stop)),
+            )
+            crop = (
+                slice(
+                    max(cell[0].start - margin, 0), min(cell[0].stop + margin, shape[0])
+                ),
+                slice(
+                    max(cell[1].start - margin, 0), min(cell[1].stop + margin, shape[1])
+                ),
+            )
+            yield cell, crop
+
+
+def estimate_band(
+    img: np.ndarray,
+    trimap: np.ndarray,
+    margin: int = 16,
+    tile_size: int = 512,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Solve closed-form matting only around the unknown region of the trimap,
+    # in crops of at most tile_size pixels plus `margin` pixels of context.
+    # Everything else takes its alpha from the trimap and its colour from the
+    # image. Takes uint8 HxWx3 and HxW arrays and returns a float32 alpha in
+    # [0, 1] and a uint8 foreground.
+    unknown = (trimap != 0) & (trimap != 255)
+    alpha = (trimap == 255).astype(np.float32)
+    foreground = img.copy()
+
+    labels, _ = label(unknown)
+
+    for box in find_objects(labels):
+        for cell, crop in _tiles(box, unknown.shape, tile_size, margin):
+            cell_unknown = unknown[cell]
+            if not cell_unknown.any():
+                continue
+
+            crop_trimap = trimap[crop]
+            has_fg = (crop_trimap == 255).any()
+            has_bg = (crop_trimap == 0).any()
+
+            # With only one kind of constraint in reach the closed-form
+            # solution is constant, and pymatting refuses to solve it.
+            if not (has_fg and has_bg):
+                alpha[cell][cell_unknown] = float(has_fg)
+                continue
+
+            crop_img = img[crop] / 255.0
+            crop_alpha = estimate_alpha_cf(crop_img, crop_trimap / 255.0)
+            crop_foreground = estimate_foreground_ml(crop_img, crop_alpha)
+
+            # position of the cell inside its crop
+            inner = (
+                slice(cell[0].start - crop[0].start, cell[0].stop - crop[0].start),
+                slice(cell[1].start - crop[1].start, cell[1].stop - crop[1].start),
+            )
+            alpha[cell][cell_unknown] = crop_alpha[inner][cell_unknown]
+            foreground[cell][cell_unknown] = np.clip(
+                crop_foreground[inner][cell_unknown] * 255, 0, 255
+            )
+
+    return alpha, foreground
+
+
+def _resize(ary: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    return np.asarray(Image.fromarray(ary).resize(size, Image.BILINEAR))
+
+
+def _guided_coefficients(
+    guide: np.ndarray, src: np.ndarray, radius: int, eps: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Box-filter guided filter (He et al.) with a single-channel guide; the
+    # box means come from uniform_filter, so the cost doesn't depend on radius.
+    size = 2 * radius + 1
+    mean_i = uniform_filter(guide, size)
+    mean_p = uniform_filter(src, size)
+    cov_ip = uniform_filter(guide * src, size) - mean_i * mean_p
+    var_i = uniform_filter(guide * guide, size) - mean_i * mean_i
+
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+
+    return uniform_filter(a, size), uniform_filter(b, size)
+
+
+def upsample_cutout(
+    img: np.ndarray,
+    img_small: np.ndarray,
+    cutout_small: np.ndarray,
+    radius: int = 4,
+    eps: float = 1e-4,
+) -> np.ndarray:
+    # Fast guided upsampling: the linear model alpha = a * I + b is fitted at
+    # the matting resolution and only its coefficients are upsampled, then
+    # applied to the full resolution luminance. The foreground keeps the
+    # full resolution image plus the upsampled low resolution correction.
+    size = (img.shape[1], img.shape[0])
+
+    guide_small = _luminance(img_small)
+    alpha_small = cutout_small[:, :, 3].astype(np.float32) / 255
+    a, b = _guided_coefficients(guide_small, alpha_small, radius, eps)
+
+    alpha = _resize(a, size) * _luminance(img) + _resize(b, size)
+
+    cutout = np.empty((img.shape[0], img.shape[1], 4), dtype=np.uint8)
+    cutout[:, :, 3] = np.clip(alpha * 255 + 0.5, 0, 255)
+
+    for c in range(3):
+        correction = cutout_small[:, :, c].astype(np.float32) - img_small[:, :, c]
+        channel = _resize(correction, size) + img[:, :, c]
+        cutout[:, :, c] = np.clip(channel + 0.5, 0, 255)
+
+    return cutout
+
+
+def _luminance(img: np.ndarray) -> np.ndarray:
+    return (
+        img[:, :, 0] * np.float32(0.299 / 255)
+        + img[:, :, 1] * np.float32(0.587 / 255)
+        + img[:, :, 2] * np.float32(0.114 / 255)
+    )
+
+
+def guided_filter(
+    img: np.ndarray, src: np.ndarray, radius: int = 8, eps: float = 1e-4
+) -> np.ndarray:
+    # Guided filter with an RGB guide. Every term is a box mean from
+    # uniform_filter and the per-pixel 3x3 systems are solved in closed form
+    # on whole arrays, so the cost is O(pixels) whatever the radius.
+    size = 2 * radius + 1
+    guide = [img[:, :, c] * np.float32(1 / 255) for c in range(3)]
+
+    mean_i = [uniform_filter(g, size) for g in guide]
+    mean_p = uniform_filter(src, size)
+    cov_ip = [uniform_filter(g * src, size) - m * mean_p for g, m in zip(guide, mean_i)]
+
+    def var(i, j):
+        v = uniform_filter(guide[i] * guide[j], size) - mean_i[i] * mean_i[j]
+        if i == j:
+            v += eps
+        return v
+
+    rr, rg, rb, gg, gb, bb = (
+        var(0, 0),
+        var(0, 1),
+        var(0, 2),
+        var(1, 1),
+        var(1, 2),
+        var(2, 2),
+    )
+
+    # inverse of the symmetric covariance matrix via its cofactors
+    inv_rr = gg * bb - gb * gb
+    inv_rg = gb * rb - rg * bb
+    inv_rb = rg * gb - gg * rb
+    inv_gg = rr * bb - rb * rb
+    inv_gb = rb * rg - rr * gb
+    inv_bb = rr * gg - rg * rg
+    det = rr * inv_rr + rg * inv_rg + rb * inv_rb
+
+    a_r = (inv_rr * cov_ip[0] + inv_rg * cov_ip[1] + inv_rb * cov_ip[2]) / det
+    a_g = (inv_rg * cov_ip[0] + inv_gg * cov_ip[1] + inv_gb * cov_ip[2]) / det
+    a_b = (inv_rb * cov_ip[0] + inv_gb * cov_ip[1] + inv_bb * cov_ip[2]) / det
+    b = mean_p - a_r * mean_i[0] - a_g * mean_i[1] - a_b * mean_i[2]
+
+    return (
+        uniform_filter(a_r, size) * guide[0]
+        + uniform_filter(a_g, size) * guide[1]
+        + uniform_filter(a_b, size) * guide[2]
+        + uniform_filter(b, size)
+    )
@@ -0,0 +1,63 @@
+from importlib.util import find_spec
+from pathlib import Path
+from typing import Dict, List, Sequence, Union
+
+import numpy as np
+from PIL.Image import Image as PILImage
+
+from .session_base import BaseSession
+
+
+# onnxruntime.quantization ships with onnxruntime but imports onnx, which is
+# an optional dependency
+def quantization_available() -> bool:
+    return find_spec("onnx") is not None
+
+
+def quantize_model(source: Path, target: Path) -> None:
+    # Dynamic quantization: weights are stored as uint8 and activations are
+    # quantized on the fly, so no calibration images are needed. ORT's CPU
+    # ConvInteger kernel only takes unsigned weights.
+    try:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+    except ImportError as e:
+        raise ImportError(
+            "Quantized models are made with onnxruntime.quantization, which "
+            "needs the onnx package; install it with `pip install onnx`."
+        ) from e
+
+    quantize_dynamic(str(source), str(target), weight_type=QuantType.QUInt8)
+
+
+def mask_iou(a: np.ndarray, b: np.ndarray, threshold: int = 128) -> float:
+    a = np.asarray(a) >= threshold
+    b = np.asarray(b) >= threshold
+    union = np.count_nonzero(a | b)
+    if union == 0:
+        return 1.0
+    return np.count_nonzero(a & b) / union
+
+
+def iou_report(
+    session: BaseSession,
+    reference: BaseSession,
+    imgs: Sequence[Union[PILImage, np.ndarray]],
+    threshold: int = 128,
+) -> Dict[str, Union[float, List[float]]]:
+    # IoU of the masks of `session` against those of `reference`, typically
+    # a quantized model against the fp32 one it was made from, with the masks
+    # binarized at `threshold`. Models with several masks are averaged over
+    # them.
+    ious = []
+    for img in imgs:
+        masks = session.predict(img)
+        expected = reference.predict(img)
+        ious.append(
+            float(np.mean([mask_iou(a, b, threshold) for a, b in zip(masks, expected)]))
+        )
+
+    return {
+        "ious": ious,
+        "mean": float(np.mean(ious)) if ious else 1.0,
+        "min": min(ious, default=1.0),
+    }
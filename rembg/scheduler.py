@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import platform
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import onnxruntime as ort
+
+from .session_factory import model_path, new_session
+
+# intra-op threads per session when the number of workers isn't given; U2Net
+# stops scaling much beyond this
+DEFAULT_INTRA_THREADS = 4
+
+
+class ThreadPlan(NamedTuple):
+    workers: int
+    intra_op_num_threads: int
+    inter_op_num_threads: int
+    # cores for each worker to be pinned to, when affinity was asked for
+    affinity: Optional[Tuple[Tuple[int, ...], ...]] = None
+
+
+def available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def plan_threads(
+    workers: Optional[int] = None,
+    intra_op_num_threads: Optional[int] = None,
+    cores: Optional[Sequence[int]] = None,
+    affinity: bool = False,
+    shared: bool = False,
+    reserved: int = 0,
+) -> ThreadPlan:
+    # Split the cores so that every ORT thread has one to itself. `reserved`
+    # cores are first set aside for other busy threads, like the decode and
+    # encode stages of a pipeline, though ORT always keeps at least half,
+    # since inference is what those stages mostly wait on. With separate
+    # sessions per worker (processes) each gets an equal share of the rest
+    # as intra-op threads. With one session shared by all workers (threads)
+    # its single intra-op pool gets all of it. Either way the inter-op pool
+    # is left at one thread, since the graphs run sequentially.
+    cores = list(cores) if cores is not None else available_cores()
+    budget = max(1, len(cores) // 2, len(cores) - reserved)
+    # the reserved cores are the first ones, so pinned workers avoid them
+    cores = cores[len(cores) - budget :]
+    n = len(cores)
+
+    if shared:
+        workers = workers or max(2, n // DEFAULT_INTRA_THREADS)
+        intra = intra_op_num_threads or n
+    else:
+        if workers is None:
+            workers = max(1, n // (intra_op_num_threads or DEFAULT_INTRA_THREADS))
+        intra = intra_op_num_threads or max(1, n // workers)
+
+    # Consecutive cores for each worker, wrapping round if the plan asks for
+    # more threads than there are cores. Workers sharing a session can't be
+    # told apart by ORT, so they aren't pinned.
+    sets = None
+    if affinity and not shared:
+        sets = tuple(
+            tuple(sorted({cores[(i * intra + j) % n] for j in range(intra)}))
+            for i in range(workers)
+        )
+
+    return ThreadPlan(workers, intra, 1, sets)
+
+
+def set_affinity(cores: Sequence[int]) -> bool:
+    # Pins the calling thread, and every thread it starts afterwards, such as
+    # the ORT pools of a session created next. Not available on every OS.
+    if not hasattr(os, "sched_setaffinity"):
+        return False
+    try:
+        os.sched_setaffinity(0, cores)
+    except OSError:
+        return False
+    return True
+
+
+_tuned: Dict[Tuple[str, Tuple[int, ...]], ThreadPlan] = {}
+
+
+def autotune(
+    model_name: str,
+    cores: Optional[Sequence[int]] = None,
+    candidates: Sequence[int] = (1, 2, 4, 8),
+    runs: int = 3,
+    reserved: int = 0,
+) -> ThreadPlan:
+    # Times inference for a few worker counts, each worker with its own
+    # session and its share of the cores as intra-op threads (see
+    # plan_threads), and returns the plan with the highest throughput.
+    # Worker threads stand in for worker processes; ORT releases the GIL
+    # while it runs. Every candidate builds a session per worker, so the
+    # result is kept per model, cores and ORT version for the life of the
+    # process, and in U2NET_HOME for later ones on the same host.
+    cores = tuple(cores) if cores is not None else tuple(available_cores())
+    key = (model_name, cores, tuple(candidates), runs, reserved)
+    if key in _tuned:
+        return _tuned[key]
+
+    record = _tuned_path(model_name)
+    record_key = hashlib.blake2b(
+        repr((key, ort.__version__, platform.machine(), platform.node())).encode(),
+        digest_size=8,
+    ).hexdigest()
+    try:
+        records = json.loads(record.read_text())
+        _tuned[key] = ThreadPlan(*records[record_key])
+        return _tuned[key]
+    except (OSError, ValueError, KeyError, TypeError):
+        records = None
+
+    img = np.random.RandomState(0).randint(0, 256, (512, 512, 3), dtype=np.uint8)
+    best = None
+
+    for workers in sorted({min(w, len(cores)) for w in candidates}):
+        plan = plan_threads(workers, cores=cores, reserved=reserved)
+        sessions = [
+            new_session(
+                model_name, plan.intra_op_num_threads, plan.inter_op_num_threads
+            )
+            for _ in range(workers)
+        ]
+        inputs = [session.preprocess([img], reuse_buffer=False) for session in sessions]
+        for session, data in zip(sessions, inputs):
+            session.run(data)
+
+        def work(session, data):
+            for _ in range(runs):
+                session.run(data)
+
+        threads = [
+            threading.Thread(target=work, args=args) for args in zip(sessions, inputs)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        rate = workers * runs / (time.perf_counter() - start)
+
+        if best is None or rate > best[0]:
+            best = (rate, plan)
+        del sessions, inputs
+
+    _tuned[key] = best[1]
+    _save_tuned(record, record_key, best[1])
+    return best[1]
+
+
+def _tuned_path(model_name: str):
+    return model_path(model_name).with_name("autotune.json")
+
+
+def _save_tuned(path, key: str, plan: ThreadPlan) -> None:
+    try:
+        records = json.loads(path.read_text())
+        if not isinstance(records, dict):
+            records = {}
+    except (OSError, ValueError):
+        records = {}
+    records[key] = [plan.workers, plan.intra_op_num_threads, plan.inter_op_num_threads]
+
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(records))
+        os.replace(tmp, path)
+    except OSError:
+        pass
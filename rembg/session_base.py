@@ -1,15 +1,49 @@
-from typing import Dict, List, Tuple
+import threading
+import warnings
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import onnxruntime as ort
 from PIL import Image
 from PIL.Image import Image as PILImage
 
+from . import array
+
 
 class BaseSession:
-    def __init__(self, model_name: str, inner_session: ort.InferenceSession):
+    mask_names: Tuple[str, ...] = ("foreground",)
+    mask_resample = Image.LANCZOS
+    # side of the square input the model was trained at
+    default_resolution = 320
+
+    def __init__(
+        self,
+        model_name: str,
+        inner_session: ort.InferenceSession,
+        resolution: Optional[int] = None,
+    ):
         self.model_name = model_name
         self.inner_session = inner_session
+        self.resolution = resolution or self.default_resolution
+        self._buffers = threading.local()
+        self._warned_batch = False
+
+    def input_size(self, resolution: Optional[int] = None) -> Tuple[int, int]:
+        resolution = resolution or self.resolution
+        size = self.inner_session.get_inputs()[0].shape[2:]
+
+        if all(isinstance(dim, int) for dim in size) and tuple(size) != (
+            resolution,
+            resolution,
+        ):
+            raise ValueError(
+                "Model {} only runs at {}x{}; create its session with "
+                "resolution={} to run it at that size.".format(
+                    self.model_name, size[1], size[0], resolution
+                )
+            )
+
+        return (resolution, resolution)
 
     def normalize(
         self,
@@ -18,23 +52,158 @@ class BaseSession:
         std: Tuple[float, float, float],
         size: Tuple[int, int],
     ) -> Dict[str, np.ndarray]:
-        im = img.convert("RGB").resize(size, Image.LANCZOS)
+        out = np.empty((1, 3, size[1], size[0]), dtype=np.float32)
+        self._normalize_into(img, mean, std, size, out[0])
+
+        return {self.inner_session.get_inputs()[0].name: out}
+
+    def normalize_batch(
+        self,
+        imgs: Sequence[PILImage],
+        mean: Tuple[float, float, float],
+        std: Tuple[float, float, float],
+        size: Tuple[int, int],
+        reuse_buffer: bool = True,
+    ) -> Dict[str, np.ndarray]:
+        # With reuse_buffer the returned tensor is a view of this thread's
+        # buffer and is only valid until the next call on the same thread.
+        if reuse_buffer:
+            out = self._input_buffer(len(imgs), size)
+        else:
+            out = np.empty((len(imgs), 3, size[1], size[0]), dtype=np.float32)
+
+        for img, ary in zip(imgs, out):
+            self._normalize_into(img, mean, std, size, ary)
+
+        return {self.inner_session.get_inputs()[0].name: out}
+
+    def _normalize_into(
+        self,
+        img: PILImage,
+        mean: Tuple[float, float, float],
+        std: Tuple[float, float, float],
+        size: Tuple[int, int],
+        out: np.ndarray,
+    ) -> None:
+        if isinstance(img, np.ndarray):
+            im_ary = array.resize(array.to_rgb(img), size)
+        else:
+            im_ary = np.asarray(img.convert("RGB").resize(size, Image.LANCZOS))
 
-        im_ary = np.array(im)
-        im_ary = im_ary / np.max(im_ary)
+        # (x / max - mean) / std folded into a single multiply-add per channel,
+        # written straight into the CHW float32 slice.
+        scale = 1.0 / (max(int(np.max(im_ary)), 1) * np.asarray(std, np.float32))
+        offset = np.asarray(mean, np.float32) / np.asarray(std, np.float32)
 
-        tmpImg = np.zeros((im_ary.shape[0], im_ary.shape[1], 3))
-        tmpImg[:, :, 0] = (im_ary[:, :, 0] - mean[0]) / std[0]
-        tmpImg[:, :, 1] = (im_ary[:, :, 1] - mean[1]) / std[1]
-        tmpImg[:, :, 2] = (im_ary[:, :, 2] - mean[2]) / std[2]
+        np.multiply(im_ary.transpose((2, 0, 1)), scale[:, None, None], out=out)
+        out -= offset[:, None, None]
 
-        tmpImg = tmpImg.transpose((2, 0, 1))
+    def _input_buffer(self, n: int, size: Tuple[int, int]) -> np.ndarray:
+        buf = getattr(self._buffers, "input", None)
 
-        return {
-            self.inner_session.get_inputs()[0]
-            .name: np.expand_dims(tmpImg, 0)
-            .astype(np.float32)
-        }
+        if buf is None or buf.shape[0] < n or buf.shape[2:] != (size[1], size[0]):
+            buf = np.empty((n, 3, size[1], size[0]), dtype=np.float32)
+            self._buffers.input = buf
 
-    def predict(self, img: PILImage) -> List[PILImage]:
+        return buf[:n]
+
+    def run(self, inputs: Dict[str, np.ndarray]) -> List[np.ndarray]:
+        # Models exported with a fixed batch dimension can't take a stacked
+        # tensor, so feed them one slice at a time and restack the outputs.
+        # That is no faster than predicting the images one by one; the copy
+        # session_factory makes for other resolutions has a dynamic batch.
+        batch = self.inner_session.get_inputs()[0].shape[0]
+        n = next(iter(inputs.values())).shape[0]
+
+        if not isinstance(batch, int) or batch == n:
+            return self.inner_session.run(None, inputs)
+
+        if not self._warned_batch:
+            self._warned_batch = True
+            warnings.warn(
+                "Model {} was exported with a batch size of {}, so batches of "
+                "{} are run one image at a time.".format(self.model_name, batch, n),
+                stacklevel=2,
+            )
+
+        outs = [
+            self.inner_session.run(
+                None, {name: ary[i : i + 1] for name, ary in inputs.items()}
+            )
+            for i in range(n)
+        ]
+        return [np.concatenate(out) for out in zip(*outs)]
+
+    def preprocess(
+        self,
+        imgs: Sequence[PILImage],
+        reuse_buffer: bool = True,
+        resolution: Optional[int] = None,
+    ) -> Dict[str, np.ndarray]:
+        raise NotImplementedError
+
+    def decode_masks(self, ort_outs: List[np.ndarray]) -> np.ndarray:
+        # (images, masks, height, width) uint8 masks at model resolution
         raise NotImplementedError
+
+    @classmethod
+    def upscale_masks(
+        cls, img: Union[PILImage, np.ndarray], masks: np.ndarray
+    ) -> Union[List[PILImage], List[np.ndarray]]:
+        # only needs the class, so cached masks can be upscaled without a
+        # loaded model
+        if isinstance(img, np.ndarray):
+            size = (img.shape[1], img.shape[0])
+            return [array.resize(mask, size) for mask in masks]
+
+        return [
+            Image.fromarray(mask).resize(img.size, cls.mask_resample) for mask in masks
+        ]
+
+    def select_masks(self, classes: Optional[Sequence[str]]) -> List[int]:
+        if classes is None:
+            return list(range(len(self.mask_names)))
+
+        unknown = [name for name in classes if name not in self.mask_names]
+        if unknown:
+            raise ValueError(
+                "Model {} has no masks {}; choose from {}.".format(
+                    self.model_name, unknown, list(self.mask_names)
+                )
+            )
+
+        return [self.mask_names.index(name) for name in classes]
+
+    def postprocess(
+        self,
+        imgs: Sequence[PILImage],
+        ort_outs: List[np.ndarray],
+        classes: Optional[Sequence[str]] = None,
+    ) -> List[List[PILImage]]:
+        # only the selected masks are upscaled to image resolution
+        selected = self.select_masks(classes)
+        return [
+            self.upscale_masks(img, masks[selected])
+            for img, masks in zip(imgs, self.decode_masks(ort_outs))
+        ]
+
+    # resolution overrides the session's for one call; masks come out at image
+    # size either way
+    def predict(
+        self,
+        img: PILImage,
+        classes: Optional[Sequence[str]] = None,
+        resolution: Optional[int] = None,
+    ) -> List[PILImage]:
+        return self.predict_batch([img], classes, resolution)[0]
+
+    def predict_batch(
+        self,
+        imgs: Sequence[PILImage],
+        classes: Optional[Sequence[str]] = None,
+        resolution: Optional[int] = None,
+    ) -> List[List[PILImage]]:
+        if len(imgs) == 0:
+            return []
+        inputs = self.preprocess(imgs, resolution=resolution)
+        return self.postprocess(imgs, self.run(inputs), classes)
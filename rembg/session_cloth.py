@@ -1,88 +1,40 @@
-from typing import List
+from typing import Dict, List, Optional, Sequence
 
 import numpy as np
 from PIL import Image
 from PIL.Image import Image as PILImage
-from scipy.special import log_softmax
 
 from .session_base import BaseSession
 
-pallete1 = [
-    0,
-    0,
-    0,
-    255,
-    255,
-    255,
-    0,
-    0,
-    0,
-    0,
-    0,
-    0,
-]
-
-pallete2 = [
-    0,
-    0,
-    0,
-    0,
-    0,
-    0,
-    255,
-    255,
-    255,
-    0,
-    0,
-    0,
-]
-
-pallete3 = [
-    0,
-    0,
-    0,
-    0,
-    0,
-    0,
-    0,
-    0,
-    0,
-    255,
-    255,
-    255,
-]
+# label ids of the upper body, lower body and full body masks; 0 is background
+cloth_classes = np.array([1, 2, 3], dtype=np.uint8)
 
 
 class ClothSession(BaseSession):
-    def predict(self, img: PILImage) -> List[PILImage]:
-        ort_outs = self.inner_session.run(
-            None, self.normalize(img, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), (768, 768))
+    mask_names = ("upper", "lower", "full")
+    mask_resample = Image.BILINEAR
+    default_resolution = 768
+
+    def preprocess(
+        self,
+        imgs: Sequence[PILImage],
+        reuse_buffer: bool = True,
+        resolution: Optional[int] = None,
+    ) -> Dict[str, np.ndarray]:
+        return self.normalize_batch(
+            imgs,
+            (0.5, 0.5, 0.5),
+            (0.5, 0.5, 0.5),
+            self.input_size(resolution),
+            reuse_buffer,
         )
 
-        pred = ort_outs
-        pred = log_softmax(pred[0], 1)
-        pred = np.argmax(pred, axis=1, keepdims=True)
-        pred = np.squeeze(pred, 0)
-        pred = np.squeeze(pred, 0)
-
-        mask = Image.fromarray(pred.astype("uint8"), mode="L")
-        mask = mask.resize(img.size, Image.LANCZOS)
-
-        masks = []
-
-        mask1 = mask.copy()
-        mask1.putpalette(pallete1)
-        mask1 = mask1.convert("RGB").convert("L")
-        masks.append(mask1)
-
-        mask2 = mask.copy()
-        mask2.putpalette(pallete2)
-        mask2 = mask2.convert("RGB").convert("L")
-        masks.append(mask2)
-
-        mask3 = mask.copy()
-        mask3.putpalette(pallete3)
-        mask3 = mask3.convert("RGB").convert("L")
-        masks.append(mask3)
+    def decode_masks(self, ort_outs: List[np.ndarray]) -> np.ndarray:
+        # softmax is monotonic, so the argmax of the logits is the label map
+        labels = np.argmax(ort_outs[0], axis=1).astype(np.uint8)
 
-        return masks
+        # All class masks in one pass at model resolution. Each is a binary
+        # image, so resampling it can't produce a neighbouring class id the
+        # way resizing the label map itself did.
+        masks = labels[:, None] == cloth_classes[None, :, None, None]
+        return masks.astype(np.uint8) * np.uint8(255)
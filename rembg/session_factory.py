@@ -1,63 +1,424 @@
 import hashlib
+import json
 import os
+import platform
 import sys
+import threading
+import warnings
 from contextlib import redirect_stdout
 from pathlib import Path
-from typing import Type
+from typing import Dict, Hashable, List, NamedTuple, Optional, Tuple, Type
 
 import gdown
 import onnxruntime as ort
 
+from .graph import make_dynamic
+from .quantization import quantization_available, quantize_model
 from .session_base import BaseSession
 from .session_cloth import ClothSession
 from .session_simple import SimpleSession
 
 
-def new_session(model_name: str) -> BaseSession:
+class ModelInfo(NamedTuple):
+    md5: str
+    url: str
     session_class: Type[BaseSession]
+    # set for models quantized locally from the fp32 model of that name
+    source: Optional[str] = None
 
-    if model_name == "u2netp":
-        md5 = "8e83ca70e441ab06c318d82300c84806"
-        url = "https://drive.google.com/uc?id=1tNuFmLv0TSNDjYIkjEdeH1IWKQdUA4HR"
-        session_class = SimpleSession
-    elif model_name == "u2net":
-        md5 = "60024c5c889badc19c04ad937298a77b"
-        url = "https://drive.google.com/uc?id=1tCU5MM1LhRgGou5OpmpjBQbSrYIUoYab"
-        session_class = SimpleSession
-    elif model_name == "u2net_human_seg":
-        md5 = "c09ddc2e0104f800e3e1bb4652583d1f"
-        url = "https://drive.google.com/uc?id=1ZfqwVxu-1XWC1xU1GHIP-FM_Knd_AX5j"
-        session_class = SimpleSession
-    elif model_name == "u2net_cloth_seg":
-        md5 = "2434d1f3cb744e0e49386c906e5a08bb"
-        url = "https://drive.google.com/uc?id=15rKbQSXQzrKCQurUjZFg8HqzZad8bcyz"
-        session_class = ClothSession
-    else:
-        assert AssertionError(
-            "Choose between u2net, u2netp, u2net_human_seg or u2net_cloth_seg"
+
+models = {
+    "u2netp": ModelInfo(
+        "8e83ca70e441ab06c318d82300c84806",
+        "https://drive.google.com/uc?id=1tNuFmLv0TSNDjYIkjEdeH1IWKQdUA4HR",
+        SimpleSession,
+    ),
+    "u2net": ModelInfo(
+        "60024c5c889badc19c04ad937298a77b",
+        "https://drive.google.com/uc?id=1tCU5MM1LhRgGou5OpmpjBQbSrYIUoYab",
+        SimpleSession,
+    ),
+    "u2net_human_seg": ModelInfo(
+        "c09ddc2e0104f800e3e1bb4652583d1f",
+        "https://drive.google.com/uc?id=1ZfqwVxu-1XWC1xU1GHIP-FM_Knd_AX5j",
+        SimpleSession,
+    ),
+    "u2net_cloth_seg": ModelInfo(
+        "2434d1f3cb744e0e49386c906e5a08bb",
+        "https://drive.google.com/uc?id=15rKbQSXQzrKCQurUjZFg8HqzZad8bcyz",
+        ClothSession,
+    ),
+}
+
+# INT8 variants, made from the verified fp32 models on first use; md5 and url
+# are those of the source. Only offered when they can be made.
+if quantization_available():
+    models.update(
+        {
+            f"{name}_int8": models[name]._replace(source=name)
+            for name in ("u2net", "u2netp")
+        }
+    )
+
+
+def _model_info(model_name: str) -> ModelInfo:
+    try:
+        return models[model_name]
+    except KeyError:
+        raise ValueError(
+            "Choose between {} or {}".format(
+                ", ".join(list(models)[:-1]), list(models)[-1]
+            )
+        ) from None
+
+
+def u2net_home() -> Path:
+    # where models and everything made from them are kept
+    return Path(os.getenv("U2NET_HOME", os.path.join("~", ".u2net"))).expanduser()
+
+
+def model_path(model_name: str) -> Path:
+    return u2net_home() / f"{model_name}.onnx"
+
+
+def _record_path(path: Path) -> Path:
+    return path.with_name(path.name + ".verified")
+
+
+def _file_stamp(path: Path) -> dict:
+    st = path.stat()
+    return {
+        "path": str(path.resolve()),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "inode": st.st_ino,
+    }
+
+
+def _is_verified(path: Path, md5: str) -> bool:
+    try:
+        record = json.loads(_record_path(path).read_text())
+        return record == {**_file_stamp(path), "md5": md5}
+    except (OSError, ValueError):
+        return False
+
+
+def _verify_file(path: Path, md5: str) -> bool:
+    hashing = hashlib.new("md5", usedforsecurity=False)
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hashing.update(chunk)
+
+    record = _record_path(path)
+    valid = hashing.hexdigest() == md5
+
+    try:
+        if valid:
+            tmp = record.with_name(record.name + ".tmp")
+            tmp.write_text(json.dumps({**_file_stamp(path), "md5": md5}))
+            os.replace(tmp, record)
+        else:
+            record.unlink(missing_ok=True)
+    except OSError:
+        pass
+
+    return valid
+
+
+# Files made locally from a downloaded model, like the quantized variants,
+# are recorded against the md5 of the model they were made from.
+
+
+def _origin_md5(model_name: str) -> str:
+    info = _model_info(model_name)
+    return models[info.source].md5 if info.source is not None else info.md5
+
+
+def _derived_record(path: Path, md5: str) -> dict:
+    return {**_file_stamp(path), "source_md5": md5}
+
+
+def _is_derived(path: Path, md5: str) -> bool:
+    try:
+        record = json.loads(_record_path(path).read_text())
+        return record == _derived_record(path, md5)
+    except (OSError, ValueError):
+        return False
+
+
+def _derive(make, source_path: Path, path: Path, md5: str) -> None:
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        make(source_path, tmp)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+    record = _record_path(path)
+    try:
+        tmp = record.with_name(record.name + ".tmp")
+        tmp.write_text(json.dumps(_derived_record(path, md5)))
+        os.replace(tmp, record)
+    except OSError:
+        pass
+
+
+def verify_model(model_name: str) -> bool:
+    path = model_path(model_name)
+    info = _model_info(model_name)
+    if info.source is not None:
+        return path.is_file() and _is_derived(path, _origin_md5(model_name))
+    return path.is_file() and _verify_file(path, info.md5)
+
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def _option(table: dict, kind: str, name: str):
+    try:
+        return table[name]
+    except KeyError:
+        raise ValueError(
+            "{} {} is not supported; choose from {}.".format(kind, name, list(table))
+        ) from None
+
+
+def optimized_model_path(
+    model_name: str, md5: str, graph_optimization_level: str, providers: List[str]
+) -> Path:
+    # Optimized graphs are only valid for the ORT version, optimization level
+    # and providers that produced them, and at the higher levels for the CPU
+    # they were made on (the host stands in for it, as U2NET_HOME may be
+    # shared), so all of them go into the file name.
+    key = hashlib.blake2b(
+        repr(
+            (
+                md5,
+                ort.__version__,
+                graph_optimization_level,
+                providers,
+                platform.machine(),
+                platform.node(),
+            )
+        ).encode(),
+        digest_size=8,
+    ).hexdigest()
+    return model_path(model_name).with_name("optimized") / f"{model_name}.{key}.onnx"
+
+
+def _inference_session(
+    path: Path,
+    sess_opts: ort.SessionOptions,
+    providers: List[str],
+    optimized: Optional[Path],
+) -> ort.InferenceSession:
+    if optimized is None:
+        return ort.InferenceSession(
+            str(path), providers=providers, sess_options=sess_opts
         )
 
-    home = os.getenv("U2NET_HOME", os.path.join("~", ".u2net"))
-    path = Path(home).expanduser() / f"{model_name}.onnx"
+    # A cached graph is loaded without optimizing it again, which is where
+    # most of the time to create a session goes.
+    if optimized.is_file():
+        level = sess_opts.graph_optimization_level
+        sess_opts.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS["disable"]
+        try:
+            return ort.InferenceSession(
+                str(optimized), providers=providers, sess_options=sess_opts
+            )
+        except Exception:
+            # ORT's errors don't share a more specific base; rebuild it below
+            optimized.unlink(missing_ok=True)
+        sess_opts.graph_optimization_level = level
+
+    # ORT writes the graph while it creates the session; it's written under a
+    # temporary name and renamed so other processes never load a partial file
+    tmp = optimized.with_name(
+        f"{optimized.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+    optimized.parent.mkdir(parents=True, exist_ok=True)
+    sess_opts.optimized_model_filepath = str(tmp)
+
+    session = ort.InferenceSession(
+        str(path), providers=providers, sess_options=sess_opts
+    )
+
+    try:
+        os.replace(tmp, optimized)
+    except OSError:
+        tmp.unlink(missing_ok=True)
+    return session
+
+
+def _download(url: str, path: Path, md5: str) -> None:
+    with redirect_stdout(sys.stderr):
+        gdown.download(url, str(path), use_cookies=False)
+    _verify_file(path, md5)
+
+
+def _fetch_model(model_name: str) -> Path:
+    md5, url, _, source = _model_info(model_name)
+
+    path = model_path(model_name)
     path.parents[0].mkdir(parents=True, exist_ok=True)
 
-    if not path.exists():
-        with redirect_stdout(sys.stderr):
-            gdown.download(url, str(path), use_cookies=False)
-    else:
-        hashing = hashlib.new("md5", path.read_bytes(), usedforsecurity=False)
-        if hashing.hexdigest() != md5:
-            with redirect_stdout(sys.stderr):
-                gdown.download(url, str(path), use_cookies=False)
+    if source is not None:
+        # quantized next to the source, again whenever the source changes
+        source_path = _fetch_model(source)
+        if not _is_derived(path, _origin_md5(model_name)):
+            _derive(quantize_model, source_path, path, _origin_md5(model_name))
+    elif not path.exists():
+        _download(url, path, md5)
+    elif not _is_verified(path, md5) and not _verify_file(path, md5):
+        _download(url, path, md5)
+
+    return path
 
+
+def _session_options(
+    intra_op_num_threads: Optional[int],
+    inter_op_num_threads: Optional[int],
+    graph_optimization_level: str,
+    execution_mode: str,
+) -> ort.SessionOptions:
     sess_opts = ort.SessionOptions()
+    sess_opts.graph_optimization_level = _option(
+        GRAPH_OPTIMIZATION_LEVELS, "Graph optimization level", graph_optimization_level
+    )
+    sess_opts.execution_mode = _option(
+        EXECUTION_MODES, "Execution mode", execution_mode
+    )
 
-    if "OMP_NUM_THREADS" in os.environ:
+    if inter_op_num_threads is not None:
+        sess_opts.inter_op_num_threads = inter_op_num_threads
+    elif "OMP_NUM_THREADS" in os.environ:
         sess_opts.inter_op_num_threads = int(os.environ["OMP_NUM_THREADS"])
 
-    return session_class(
+    if intra_op_num_threads is not None:
+        sess_opts.intra_op_num_threads = intra_op_num_threads
+
+    return sess_opts
+
+
+def _fixed_size(inner_session: ort.InferenceSession) -> Optional[Tuple[int, ...]]:
+    size = tuple(inner_session.get_inputs()[0].shape[2:])
+    return size if all(isinstance(dim, int) for dim in size) else None
+
+
+def new_session(
+    model_name: str,
+    intra_op_num_threads: Optional[int] = None,
+    inter_op_num_threads: Optional[int] = None,
+    graph_optimization_level: str = "all",
+    execution_mode: str = "sequential",
+    cache_optimized: bool = True,
+    resolution: Optional[int] = None,
+) -> BaseSession:
+    # resolution is the side of the square the images are resized to for
+    # inference, by default the one the model was trained at
+    md5, _, session_class, _ = _model_info(model_name)
+    path = _fetch_model(model_name)
+    providers = ort.get_available_providers()
+
+    def load(path):
+        sess_opts = _session_options(
+            intra_op_num_threads,
+            inter_op_num_threads,
+            graph_optimization_level,
+            execution_mode,
+        )
+        optimized = None
+        if cache_optimized and graph_optimization_level != "disable":
+            optimized = optimized_model_path(
+                path.stem, md5, graph_optimization_level, providers
+            )
+        return _inference_session(path, sess_opts, providers, optimized)
+
+    # A graph exported with a fixed input size only runs at that size; for any
+    # other resolution a copy of it with dynamic height and width is made next
+    # to it and used instead. Making it needs onnx; without it the model runs
+    # at its own size. The dynamic copy is slower, so the model's own
+    # resolution always loads the original graph.
+    dynamic = path.with_name(f"{model_name}.dynamic.onnx")
+    if resolution not in (None, session_class.default_resolution) and _is_derived(
+        dynamic, _origin_md5(model_name)
+    ):
+        path = dynamic
+
+    inner_session = load(path)
+    size = _fixed_size(inner_session)
+    if resolution is not None and size not in (None, (resolution, resolution)):
+        try:
+            _derive(make_dynamic, path, dynamic, _origin_md5(model_name))
+        except ImportError as e:
+            warnings.warn(
+                "Model {} only runs at {}x{}, so it is used at that size: {}".format(
+                    model_name, size[1], size[0], e
+                ),
+                stacklevel=2,
+            )
+            resolution = size[0]
+        else:
+            inner_session = load(dynamic)
+
+    return session_class(model_name, inner_session, resolution)
+
+
+_sessions: Dict[Tuple[Hashable, ...], BaseSession] = {}
+_sessions_lock = threading.Lock()
+_session_locks: Dict[Tuple[Hashable, ...], threading.Lock] = {}
+
+
+# options left at None are the defaults, so asking for them explicitly
+# shares the session
+def _session_key(model_name: str, options: dict) -> Tuple[Hashable, ...]:
+    return (
         model_name,
-        ort.InferenceSession(
-            str(path), providers=ort.get_available_providers(), sess_options=sess_opts
-        ),
+        *sorted((name, value) for name, value in options.items() if value is not None),
     )
+
+
+def get_session(model_name: str, **options) -> BaseSession:
+    key = _session_key(model_name, options)
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is not None:
+            return session
+        lock = _session_locks.setdefault(key, threading.Lock())
+
+    # Only one thread builds a given session; the others wait for it here
+    # instead of creating a duplicate.
+    with lock:
+        with _sessions_lock:
+            session = _sessions.get(key)
+        if session is None:
+            session = new_session(model_name, **options)
+            with _sessions_lock:
+                _sessions[key] = session
+
+    return session
+
+
+def release_session(model_name: str, **options) -> None:
+    key = _session_key(model_name, options)
+
+    with _sessions_lock:
+        _sessions.pop(key, None)
+        _session_locks.pop(key, None)
+
+
+def clear_sessions() -> None:
+    with _sessions_lock:
+        _sessions.clear()
+        _session_locks.clear()
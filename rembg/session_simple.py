@@ -1,30 +1,32 @@
-from typing import List
+from typing import Dict, List, Optional, Sequence
 
 import numpy as np
-from PIL import Image
 from PIL.Image import Image as PILImage
 
 from .session_base import BaseSession
 
 
 class SimpleSession(BaseSession):
-    def predict(self, img: PILImage) -> List[PILImage]:
-        ort_outs = self.inner_session.run(
-            None,
-            self.normalize(
-                img, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)
-            ),
+    def preprocess(
+        self,
+        imgs: Sequence[PILImage],
+        reuse_buffer: bool = True,
+        resolution: Optional[int] = None,
+    ) -> Dict[str, np.ndarray]:
+        return self.normalize_batch(
+            imgs,
+            (0.485, 0.456, 0.406),
+            (0.229, 0.224, 0.225),
+            self.input_size(resolution),
+            reuse_buffer,
         )
 
-        pred = ort_outs[0][:, 0, :, :]
+    def decode_masks(self, ort_outs: List[np.ndarray]) -> np.ndarray:
+        preds = ort_outs[0][:, 0, :, :]
 
-        ma = np.max(pred)
-        mi = np.min(pred)
+        ma = np.max(preds, axis=(1, 2), keepdims=True)
+        mi = np.min(preds, axis=(1, 2), keepdims=True)
 
-        pred = (pred - mi) / (ma - mi)
-        pred = np.squeeze(pred)
+        preds = (preds - mi) / (ma - mi)
 
-        mask = Image.fromarray((pred * 255).astype("uint8"), mode="L")
-        mask = mask.resize(img.size, Image.LANCZOS)
-
-        return [mask]
+        return (preds * 255).astype("uint8")[:, None]